@@ -1,5 +1,5 @@
+import copy
 import json
-import shlex
 import os
 import stat
 import re
@@ -8,6 +8,7 @@ import sys
 import pprint
 import tempfile
 import shutil
+import time
 import logging
 import StringIO
 import argparse
@@ -24,6 +25,13 @@ from litpcli.litp import LitpCli, SortedChoicesArgumentParser
 from litpats.mock_http_connection import MockHTTPConnection
 from litp.core.litpcrypt import pad
 from litpats.mockfilesystem import MockFilesystem
+from litpats.atcompiler import INCLUDED_SCRIPT
+from litpats.atcompiler import ScriptBatch
+from litpats.atcompiler import batch_assertions
+from litpats.atcompiler import compile_script
+from litpats.checkpoints import checkpoint_key
+from litpats.db_snapshot import DbSnapshot
+from litpats.direct_dispatch import direct_request
 
 from litp.data.db_storage import DbStorage
 from litp.data.test_db_engine import get_engine
@@ -57,6 +65,8 @@ path: /opt/ericsson/nms/litp/etc/litp_shadow
 """
 SECURITY_KEYSET = "j0zP+vqUgnCJQ6W+ErOmv39KF4jmfuHVvOfu0dG5i3w="
 ansi_escape = re.compile(r'\x1b[^m]*m')
+# A reference to an AT variable, ${name}, along with any quotes around it
+env_reference = re.compile(r"'?\$\{([^{}]+)\}'?")
 celery_app.conf.CELERY_ALWAYS_EAGER = True
 
 
@@ -95,6 +105,65 @@ def handled_errors(args):
         raise AssertionError("Unexpected exception for command %s" % (args,))
 
 
+def _error_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--err_type", dest="type")
+    parser.add_argument("--err_message", dest="message")
+    parser.add_argument("--err_vpath", dest="vpath")
+    parser.add_argument("--err_property", dest="property")
+    return parser
+
+
+def _error_length_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--errors_length", dest="length")
+    return parser
+
+
+def _apd_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', dest='path', nargs=1)
+    parser.add_argument('expected_apd', nargs=1)
+    return parser
+
+
+def _source_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", dest="vpath", type=str, required=True)
+    parser.add_argument("-s", dest="source", type=str, required=True)
+    parser.add_argument("--inheritance_layers",
+                        dest="inheritance_layers",
+                        type=int)
+    return parser
+
+
+def _unescape(value):
+    return value.replace(r'\n', '\n').replace(r'\#', r'#')
+
+
+def _env_lookup(environment, name):
+    # Variables are referred to by their lowercased names
+    if name != name.lower():
+        return None
+    for key in (name, name.upper()):
+        if key in environment:
+            return environment[key]
+    for key, value in environment.iteritems():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def _eval_value(value):
+    if isinstance(value, FuturePropertyValue):
+        return value.value
+    elif isinstance(value, list):
+        return [_eval_value(i) for i in value]
+    elif isinstance(value, dict):
+        return dict((k, _eval_value(v)) for (k, v) in value.iteritems())
+    return value
+
+
 def _use_colour_output():
     try:
         stdout_is_tty_like = any((
@@ -141,6 +210,15 @@ def _print_verbose(cli, msg, print_to_console=False):
         cli.verbose_log_file.write("{0}\n".format(ansi_escape.sub('', msg)))
 
 
+def _print_script_line(cli, line, command, args, ret):
+    if ret == "Pass":
+        _print_verbose(cli, "{0:4}: {1} {2} {3}".format(line,
+            _green("Pass"), command, " ".join(args)), False)
+    else:
+        _print_verbose(cli, "{0:4}: {1} {2}".format(line, command,
+            " ".join(args)), False)
+
+
 class Mock(object):
     pass
 
@@ -165,8 +243,166 @@ class MetaData(object):
         self.referred_tasks = {}
 
 
+class LandscapeSnapshot(object):
+    '''
+    The state of a landscape right after it has been created from scratch,
+    kept so that later ``clearLandscape`` calls can restore it without
+    loading the plugins and extensions again.
+
+    The database rows and the plugin manager are kept. The model manager
+    holds state of its own, such as the logging level, so a new one is built
+    for every restore and the plugin manager is bound to it, along with the
+    property and item types that the extensions registered.
+    '''
+
+    def __init__(self, engine, storage, model_manager, plugin_manager):
+        self.engine = engine
+        self.storage = storage
+        self.plugin_manager = plugin_manager
+        self.property_types = model_manager.property_types.values()
+        self.item_types = model_manager.item_types.values()
+        self.maintenance = cherrypy.config.get('maintenance')
+        self.db = DbSnapshot.take(engine)
+
+    def restore(self):
+        self.db.restore(self.engine)
+        cherrypy.config.update({
+            'db_storage': self.storage,
+            'maintenance': self.maintenance,
+        })
+
+    def bind(self, model_manager):
+        '''
+        Registers the extensions' types with a new model manager and returns
+        the plugin manager, bound to it.
+        '''
+        model_manager.register_property_types(self.property_types)
+        model_manager.register_item_types(self.item_types)
+        self.plugin_manager.model_manager = model_manager
+        return self.plugin_manager
+
+
+class ScriptCheckpoint(object):
+    '''
+    The state of a landscape right after an included script has been run
+    on a freshly cleared landscape: the database, the mocked filesystem, the
+    AT metadata and the log messages that running the script added.
+    '''
+
+    # The commands that included scripts can run and still be checkpointed,
+    # along with any assertion. Other commands change state that is not
+    # part of a checkpoint.
+    COMMANDS = frozenset([
+        'litp', 'create', 'show', 'let', 'getProperty', 'runLitpScript',
+        'addMockDirectory', 'litpcrypt', 'failConfigTask', 'unfailConfigTask',
+        'failCallbackTask', 'unfailCallbackTask', 'failSnapshotPlan',
+        'disableCallbackMock', 'disableCallbackMockInNextSnapshotPlan',
+    ])
+    # The litp commands that create, run or remove plans. The plan and the
+    # state of running it are held by the execution manager, outside the
+    # database, so a checkpoint cannot be taken after them.
+    PLAN_COMMANDS = frozenset([
+        'create_plan', 'run_plan', 'stop_plan', 'remove_plan',
+        'create_snapshot', 'remove_snapshot', 'restore_snapshot',
+        'restore_model', 'prepare_restore',
+    ])
+
+    def __init__(self, engine, filesystem, meta, log):
+        self.db = DbSnapshot.take(engine)
+        self.filesystem = filesystem
+        self.meta = copy.deepcopy(meta)
+        self.maintenance = cherrypy.config.get('maintenance')
+        self.log = log
+
+    @classmethod
+    def covers(cls, commands):
+        '''
+        Returns whether a script that ran the given commands, with the litp
+        commands given as "litp <subcommand>", can be checkpointed.
+        '''
+        for command in commands:
+            if command.startswith('litp '):
+                if command.split(' ', 1)[1] in cls.PLAN_COMMANDS:
+                    return False
+            elif command not in cls.COMMANDS and \
+                    not command.startswith('assert'):
+                return False
+        return True
+
+
+class PlanIndex(object):
+    '''
+    Where the tasks of a plan are, as (phase, index) positions, by the
+    attributes that assertions look them up by, along with the task counts
+    they check.
+
+    Only positions are kept, since every command runs in its own scope and
+    loads the tasks again. The index is only valid until the plan changes,
+    so ATCli drops it whenever a command that may change the plan runs.
+    '''
+
+    def __init__(self, phases):
+        # By (type, call_type, call_id, vpath), with call_id only set for
+        # ConfigTasks
+        self.tasks = {}
+        # By call_type
+        self.calls = {}
+        # By (vpath, action)
+        self.remote_tasks = {}
+        # ConfigTasks, by node hostname
+        self.config_tasks = {}
+        self.callback_tasks = 0
+        # (lock tasks, unlock tasks), by model item hostname
+        self.lock_tasks = {}
+        # The arguments of tasks read by assertions, by what was read and
+        # the position of the task
+        self.task_args = {}
+
+        for p, phase in enumerate(phases):
+            for t, task in enumerate(phase):
+                self._add(task, (p, t))
+
+    def _add(self, task, position):
+        task_type = type(task)
+        call_id = task.call_id if task_type is ConfigTask else None
+        self.tasks.setdefault((task_type, task.call_type, call_id,
+                               task._model_item_vpath), []).append(position)
+        self.calls.setdefault(task.call_type, []).append(position)
+        if task_type is ConfigTask:
+            hostname = task.node.hostname
+            self.config_tasks[hostname] = \
+                self.config_tasks.get(hostname, 0) + 1
+        elif task_type is CallbackTask:
+            self.callback_tasks += 1
+        elif task_type is RemoteExecutionTask:
+            self.remote_tasks.setdefault(
+                (task._model_item_vpath, task.action), []).append(position)
+
+        if not isinstance(task.model_item, basestring):
+            hostname = getattr(task.model_item, 'hostname', '')
+            lock_tasks, unlock_tasks = self.lock_tasks.get(hostname, (0, 0))
+            if task.lock_type == task.TYPE_LOCK:
+                lock_tasks += 1
+            if task.lock_type == task.TYPE_UNLOCK:
+                unlock_tasks += 1
+            self.lock_tasks[hostname] = (lock_tasks, unlock_tasks)
+
+
 class ATCli(LitpCli):
     DEFAULT_ROOT = '/opt/ericsson/nms/litp'
+    DIRECT_DISPATCH_URL = 'https://localhost:9999/litp/rest/v1'
+
+    # The parsers for the arguments of assertion commands, by the function
+    # building them, built the first time they are needed
+    _parsers = {}
+    # The errors expected by let variables, by the arguments of the variables
+    _let_error_specs = {}
+
+    # Commands other than assertions that leave the plan as it is, so that
+    # the task assertions around them can share one index of the plan
+    PLAN_PRESERVING_COMMANDS = frozenset(['let'])
+    # Assertions that run LITP commands, which may change the plan
+    PLAN_CHANGING_ASSERTIONS = frozenset(['assertError', 'assertErrorMessage'])
 
     def __init__(self):
         super(ATCli, self).__init__()
@@ -256,9 +492,23 @@ class ATCli(LitpCli):
         self.result = {}
         self.printout = False
         self.temp_dir = None
+        self.xsd_path = None
+        self.xsd_cache = None
+        self.script_cache_dir = None
         self.extra_extensions = []
         self.let_container = dict()
         self.xsds_generated = False
+        self.snapshot_landscape = False
+        self.landscape_snapshot = None
+        self.script_checkpoints = None
+        self.landscape_cleared = False
+        self.commands_run = None
+        self.direct_dispatch = False
+        self.plan_index = None
+        self.batch_phases = None
+        self.assertion_args = {}
+        self.db_engine = None
+        self.dependency_tracker = None
         self.original_error_handler = SortedChoicesArgumentParser.error
         SortedChoicesArgumentParser.error = self.argparser_error_handler()
         self.meta = MetaData()
@@ -364,21 +614,34 @@ class ATCli(LitpCli):
             clearLandscape
         '''
 
-        self._create_new_model()
-        self.create_litp_services()
+        if self.landscape_snapshot is not None:
+            self._restore_landscape()
+        else:
+            self._create_new_model()
+            self.create_litp_services()
 
         self.xsds_generated = False
         self.reconfigure_server()
 
+    def _restore_landscape(self):
+        # The snapshot's database rows have already been restored by run(),
+        # along with a new model manager
+        self.plugin_manager = self.landscape_snapshot.bind(self.model_manager)
+        self._reset_logging_level()
+        self._create_execution()
+
+    def _reset_logging_level(self):
+        # These 2 lines are meant to emulate the operations performed by the
+        # LitpServiceController when /litp/logging is updated
+        self.model_manager.configuration_logging_level = logging.INFO
+        self.model_manager.set_debug(True)
+
     def create_litp_services(self):
         model_manager = self.model_manager
         logging_item = model_manager.create_item('logging', '/litp/logging')
-        # These 2 lines are meant to emulate the operations performed by the
-        # LitpServiceController when /litp/logging is updated
         # pylint: disable=E1103
         logging_item.properties['force_debug'] = 'true'
-        model_manager.configuration_logging_level = logging.INFO
-        model_manager.set_debug(True)
+        self._reset_logging_level()
         model_manager.create_item('restore', '/litp/restore_model')
         model_manager.create_item('prepare-restore', '/litp/prepare-restore')
         if not model_manager.has_item('/litp/maintenance'):
@@ -429,23 +692,31 @@ class ATCli(LitpCli):
                 pass
 
     def _create_xml_loader(self):
-        schema_path = os.path.join(self.temp_dir, "share", "xsd")
-        xsd_file = os.path.join(schema_path, "litp.xsd")
+        xsd_file = os.path.join(self.xsd_path, "litp.xsd")
         xml_loader = XmlLoader(self.model_manager, xsd_file)
         return xml_loader
 
     def _create_xml_exporter(self):
-        schema_path = os.path.join(self.temp_dir, "share", "xsd")
         xml_exporter = XmlExporter(self.model_manager)
         return xml_exporter
 
     def _generate_xsd_schema(self):
-        self.temp_dir = tempfile.mkdtemp(prefix="litp_xsds_")
-        schema_path = os.path.join(self.temp_dir, "share", "xsd")
-        os.makedirs(schema_path)
         basepaths = [os.path.join(self.root_path, "etc/plugins"),
             os.path.join(self.root_path, "etc/extensions")]
-        SchemaWriter(schema_path, basepaths + self.extra_extensions).write()
+        extension_paths = basepaths + self.extra_extensions
+
+        def write_schema(schema_path):
+            SchemaWriter(schema_path, extension_paths).write()
+
+        if self.xsd_cache is not None:
+            self.temp_dir = None
+            self.xsd_path = self.xsd_cache.schema_path(extension_paths,
+                                                       write_schema)
+            return
+        self.temp_dir = tempfile.mkdtemp(prefix="litp_xsds_")
+        self.xsd_path = os.path.join(self.temp_dir, "share", "xsd")
+        os.makedirs(self.xsd_path)
+        write_schema(self.xsd_path)
 
     def _print_out(self, msg):
         if self.printout:
@@ -456,14 +727,19 @@ class ATCli(LitpCli):
             super(ATCli, self)._print_err(msg)
 
     def _create_new_model(self):
+        self._load_plugins()
+        update_plugins(scope.data_manager, self.plugin_manager)
+        self.plugin_manager.add_default_model()
+        self._create_execution()
+
+    def _load_plugins(self):
         self.plugin_manager = PluginManager(self.model_manager)
         self.plugin_manager.add_extensions(os.path.join(self.root_path,
             "etc/extensions"))
         self.plugin_manager.add_plugins(os.path.join(self.root_path,
             "etc/plugins"))
-        update_plugins(scope.data_manager, self.plugin_manager)
-        self.plugin_manager.add_default_model()
 
+    def _create_execution(self):
         self.puppet_manager = PuppetManager(self.model_manager)
         self.execution = ExecutionManager(
             self.model_manager, self.puppet_manager, self.plugin_manager)
@@ -500,7 +776,13 @@ class ATCli(LitpCli):
             litp create -p /infrastructure/systems/sys1 system
         '''
         all_args = list(args)
-        result = self.run_command(all_args)
+        request = None
+        if self.direct_dispatch and not self.printout:
+            request = direct_request(all_args)
+        if request is not None:
+            result = self._run_direct_request(request)
+        else:
+            result = self.run_command(all_args)
         if self.errors:
             if self.show_errors:
                 raise AssertionError(
@@ -516,6 +798,24 @@ class ATCli(LitpCli):
             raise AssertionError("Error in call: %s" % self.result)
         return result
 
+    def _run_direct_request(self, request):
+        '''
+        Sends a request built by direct dispatch straight to the mocked REST
+        API, bypassing the LITP CLI's argument parsing and response handling.
+        Returns 0 if it succeeded and 1 if it failed, with the response in
+        self.result in either case.
+        '''
+        headers = {'Content-Type': 'application/json'}
+        body = request.body if request.body is not None else ''
+        connection = self._create_http_connection('localhost')
+        with MockFilesystemContext(self):
+            connection.request(request.method, self.DIRECT_DISPATCH_URL +
+                               request.path, body, headers)
+        self.result = {}
+        with ignored(ValueError):
+            self.result = json.loads(connection.getresponse().read())
+        return 1 if self._get_errors(self.result) else 0
+
     def _execute_request(self, url, method, data, content_type):
         result, errors = super(ATCli, self)._execute_request(
                                             url, method, data, content_type)
@@ -576,24 +876,14 @@ class ATCli(LitpCli):
 'collection requires a minimum of 1 items not marked for removal' create_plan
 
         """
-        err_parser = argparse.ArgumentParser()
-        err_parser.add_argument("--err_type", dest="type")
-        err_parser.add_argument("--err_message", dest="message")
-        err_parser.add_argument("--err_vpath", dest="vpath")
-        err_parser.add_argument("--err_property", dest="property")
-
-        err_len_parser = argparse.ArgumentParser()
-        err_len_parser.add_argument("--errors_length", dest="length")
-
-        pargs = err_parser.parse_known_args(args)
-        err_len_pargs = err_len_parser.parse_known_args(pargs[1])
+        pargs = self._parser(_error_parser).parse_known_args(args)
+        err_len_pargs = self._parser(_error_length_parser).parse_known_args(
+            pargs[1])
 
         assert_args = [pargs[0]]
         err_len_args = err_len_pargs[0]
 
-        parse = lambda arg: err_parser.parse_known_args(
-                                    self.let_container[arg])[0]
-        let_args = [parse(arg) for arg in pargs[1]
+        let_args = [self._let_error_spec(arg) for arg in pargs[1]
                         if arg in self.let_container]
         litp_args = [arg for arg in err_len_pargs[1]
                         if arg not in self.let_container]
@@ -623,6 +913,19 @@ class ATCli(LitpCli):
 
             return result
 
+    @classmethod
+    def _parser(cls, build_parser):
+        if build_parser not in cls._parsers:
+            cls._parsers[build_parser] = build_parser()
+        return cls._parsers[build_parser]
+
+    def _let_error_spec(self, var_name):
+        let_args = self.let_container[var_name]
+        if let_args not in self._let_error_specs:
+            self._let_error_specs[let_args] = self._parser(
+                _error_parser).parse_known_args(let_args)[0]
+        return self._let_error_specs[let_args]
+
     def _get_args_to_validate(self, assert_args):
         to_validate = dict()
         for arg in dir(assert_args):
@@ -817,35 +1120,178 @@ can only contain tasks for the same node"
         return MockHTTPConnection(host)
 
     def _configure_storage(self):
-        storage = DbStorage(get_engine())
+        self.db_engine = get_engine()
+        storage = DbStorage(self.db_engine)
         storage.reset()
         cherrypy.config["db_storage"] = storage
 
+        self._create_model_manager()
+
+    def _create_model_manager(self):
         self.model_manager = ModelManager()
         cherrypy.config["model_manager"] = self.model_manager
 
-    def run(self, command, args):
+    def _start_command(self, command, args):
+        '''
+        Does the bookkeeping needed before any command is run, and returns
+        its arguments with the AT variables substituted, along with whether
+        the landscape was cleared right before it.
+        '''
         args = [self._env(arg) for arg in args]
 
         self._check_debug()
 
+        if self._may_change_plan(command):
+            self.plan_index = None
+        self.assertion_args = {}
+
+        landscape_cleared, self.landscape_cleared = \
+                self.landscape_cleared, False
+        if self.commands_run is not None:
+            if command == 'litp' and args:
+                self.commands_run.add('litp %s' % args[0])
+            else:
+                self.commands_run.add(command)
+        return args, landscape_cleared
+
+    def run(self, command, args):
+        args, landscape_cleared = self._start_command(command, args)
+
         if command == "runLitpScript":
+            if landscape_cleared and self.script_checkpoints is not None \
+                    and self.dependency_tracker is None:
+                return self._run_checkpointed_script(*args)
             return self.commands[command](*args)
 
         if command == "clearLandscape":
-            self._configure_storage()
+            if self.landscape_snapshot is None:
+                self._configure_storage()
+            else:
+                self.landscape_snapshot.restore()
+                self._create_model_manager()
+
+        result = self._run(command, args)
 
-        return self._run(command, args)
+        if command == "clearLandscape" and self.snapshot_landscape and \
+                self.landscape_snapshot is None:
+            self.landscape_snapshot = LandscapeSnapshot(self.db_engine,
+                cherrypy.config["db_storage"], self.model_manager,
+                self.plugin_manager)
+        return result
+
+    def _may_change_plan(self, command):
+        '''
+        Returns whether the command may change the plan, and so the plan
+        index has to be built again after it.
+        '''
+        if command.startswith('assert'):
+            return command in self.PLAN_CHANGING_ASSERTIONS
+        return command not in self.PLAN_PRESERVING_COMMANDS
 
     @threadlocal_scope
     def _run(self, command, args):
         return self.commands[command](*args)
 
+    @threadlocal_scope
+    def run_assertions(self, script_lines):
+        '''
+        Runs a batch of consecutive task assertions, given as ScriptLines,
+        against a single reading of the plan. Every assertion is run on its
+        own line, and one that fails does not stop the others.
+
+        Returns a (script_line, result, duration) tuple for each assertion.
+        If any of them failed, self.line is set to the line of the first
+        failure and its AssertionError is raised instead, or one listing
+        every failure with its line number if there were several.
+        '''
+        results = []
+        failures = []
+        self.line = script_lines[0].line
+        self.batch_phases = self.execution.plan_phases()
+        try:
+            for script_line in script_lines:
+                self.line = script_line.line
+                start_time = time.time()
+                args, _ = self._start_command(script_line.command,
+                                              script_line.args)
+                try:
+                    result = self.commands[script_line.command](*args)
+                except AssertionError as ex:
+                    failures.append((script_line.line, ex))
+                    continue
+                results.append((script_line, result,
+                                time.time() - start_time))
+        finally:
+            self.batch_phases = None
+
+        if len(failures) == 1:
+            self.line = failures[0][0]
+            raise failures[0][1]
+        if failures:
+            self.line = failures[0][0]
+            raise AssertionError("\n".join(
+                "Line %s: %s" % (line, ex) for line, ex in failures))
+        return results
+
+    def _run_checkpointed_script(self, script_file):
+        '''
+        Restores the checkpoint taken after the script was last run on a
+        freshly cleared landscape, or runs the script and takes one.
+        '''
+        key = checkpoint_key(os.path.abspath(self._local(script_file)),
+                             self._read_file(script_file),
+                             sorted(self.environment.items()))
+        checkpoint = self.script_checkpoints.load(key)
+        if checkpoint is not None:
+            self._restore_checkpoint(checkpoint)
+            return
+
+        log_buffer = self._buffer_logs()
+        log_start = len(log_buffer.getvalue())
+        self.commands_run = set()
+        try:
+            self.command_run_litp_script(script_file)
+            commands_run = self.commands_run
+        finally:
+            self.commands_run = None
+
+        if self.update_expected or not ScriptCheckpoint.covers(commands_run):
+            return
+        filesystem = self.filesystem.checkpoint()
+        if filesystem is None:
+            return
+        self.script_checkpoints.save(key, ScriptCheckpoint(self.db_engine,
+            filesystem, self.meta, log_buffer.getvalue()[log_start:]))
+
+    def _restore_checkpoint(self, checkpoint):
+        checkpoint.db.restore(self.db_engine)
+        self.filesystem.restore_checkpoint(checkpoint.filesystem)
+        self.meta.__dict__.update(copy.deepcopy(checkpoint.meta.__dict__))
+        cherrypy.config.update({'maintenance': checkpoint.maintenance})
+        self._buffer_logs().write(checkpoint.log)
+
     def _env(self, line):
-        for key, value in self.environment.items():
-            line = line.replace("'${%s}'" % key.lower(), value)
-            line = line.replace("${%s}" % key.lower(), value)
-        return line
+        '''
+        Replaces every ${name}, or '${name}' along with its quotes, with the
+        value of the variable whose lowercased name it is.
+        '''
+        if not self.environment or '${' not in line:
+            return line
+        return env_reference.sub(self._env_value, line)
+
+    def _env_value(self, match):
+        reference = match.group(0)
+        value = _env_lookup(self.environment, match.group(1))
+        if value is None:
+            return reference
+        if reference.startswith("'") and reference.endswith("'"):
+            return value
+        # Only a quote on one side of the reference is kept
+        if reference.startswith("'"):
+            value = "'" + value
+        if reference.endswith("'"):
+            value += "'"
+        return value
 
     def _check_debug(self):
         if self.debug_line == self.line:
@@ -900,10 +1346,7 @@ can only contain tasks for the same node"
             assertAppliedPropertiesDeterminable \
 -p /deployments/dep1/nodes/node2 False
         '''
-        apd_parser = argparse.ArgumentParser()
-        apd_parser.add_argument('-p', dest='path', nargs=1)
-        apd_parser.add_argument('expected_apd', nargs=1)
-        apd_args = apd_parser.parse_args(args)
+        apd_args = self._parser(_apd_parser).parse_args(args)
 
         if not apd_args.path:
             raise AssertionError("Item path specification mandatory")
@@ -1044,14 +1487,7 @@ can only contain tasks for the same node"
     node2/services/parent1 -s /software/services/parent1 --inheritance_layers 2
         '''
 
-        arg_parser = argparse.ArgumentParser()
-        arg_parser.add_argument("-p", dest="vpath", type=str, required=True)
-        arg_parser.add_argument("-s", dest="source", type=str, required=True)
-        arg_parser.add_argument("--inheritance_layers",
-                                dest="inheritance_layers",
-                                type=int)
-
-        pargs = arg_parser.parse_known_args(args)
+        pargs = self._parser(_source_parser).parse_known_args(args)
         assert_args = pargs[0]
 
         src_vpath = assert_args.vpath
@@ -1248,12 +1684,11 @@ can only contain tasks for the same node"
         if self.update_expected:
             self._copy_actual_to_expected(actual, expected)
         else:
-            for filename in self.filesystem._files.keys():
-                if filename.startswith(actual):
-                    expected_filename = os.path.join(self._local(expected),
-                                                     filename[len(actual):])
-                    self.command_assert_file_contents(expected_filename,
-                                                      filename)
+            for filename in self.filesystem.files_under(actual):
+                expected_filename = os.path.join(self._local(expected),
+                                                 filename[len(actual):])
+                self.command_assert_file_contents(expected_filename,
+                                                  filename)
 
             expected = self._local(expected)
             for root, dirs, files in os.walk(expected):
@@ -1306,45 +1741,44 @@ can only contain tasks for the same node"
         cli.verbose = self.verbose
         cli.show_errors = self.show_errors
         cli.server = self.server
+        cli.dependency_tracker = self.dependency_tracker
+        cli.script_cache_dir = self.script_cache_dir
+        cli.commands_run = self.commands_run
+        cli.direct_dispatch = self.direct_dispatch
         cli.environment = self.environment.copy()
-        script = self._read_file(script_file).split("\n")
+        script = compile_script(self._read_file(script_file), INCLUDED_SCRIPT,
+                                self.script_cache_dir)
         cli.line = 0
         cli.meta = self.meta
-        previous_line = ''
-        for line in script:
-            if line.endswith("\\"):
-                previous_line += line.split("\\")[0]
-                cli.line += 1
+        for script_line in batch_assertions(script):
+            if isinstance(script_line, ScriptBatch):
+                for line, ret, _ in cli.run_assertions(script_line.lines):
+                    _print_script_line(cli, line.line, line.command,
+                                       line.args, ret)
                 continue
-            if previous_line:
-                line = previous_line + line
-                previous_line = ''
-            cli.line += 1
-            line = line.split("#")[0]
-            if line.startswith('../'):
-                line = 'runLitpScript ' + line
-            args = shlex.split(line)
-            if args:
-                command = args.pop(0)
-                if command in self.commands:
-                    if cli.run(command, args) == "Pass":
-                        _print_verbose(cli, "{0:4}: {1} {2} {3}".format(cli.
-                            line, _green("Pass"), command, " ".join(args)),
-                            False)
-                    else:
-                        _print_verbose(cli, "{0:4}: {1} {2}".format(cli.line,
-                            command, " ".join(args)), False)
+            line_number, command, args, error = script_line
+            cli.line = line_number
+            if error is not None:
+                raise ValueError(error)
+            if command in self.commands:
+                _print_script_line(cli, cli.line, command, args,
+                                   cli.run(command, args))
 
     def _read_file(self, filename):
         if self.filesystem.mock_exists(filename):
             return self.filesystem.mock_open(filename).read().strip()
         elif os.path.exists(self._local(filename)):
-            return open(self._local(filename)).read().strip()
+            return self._read_real_file(self._local(filename)).strip()
         elif os.path.exists(self._include_file(filename)):
-            return open(self._include_file(filename)).read().strip()
+            return self._read_real_file(self._include_file(filename)).strip()
         else:
             raise Exception("No such file %s" % (filename,))
 
+    def _read_real_file(self, path):
+        if self.dependency_tracker is not None:
+            self.dependency_tracker.add_path(path)
+        return open(path).read()
+
     def _local(self, filename):
         return os.path.join(self.test_dir, filename)
 
@@ -1459,11 +1893,28 @@ can only contain tasks for the same node"
         return 'Pass'
 
     def _get_phase(self, phase_index):
-        plan = self.execution.plan_phases()
+        plan = self._plan_phases()
         if phase_index >= len(plan):
             raise AssertionError("No such phase %s in plan" % (phase_index,))
         return plan[phase_index]
 
+    def _plan_tasks(self):
+        '''
+        Returns the phases of the current plan along with the index of their
+        tasks, which is built once for any series of assertions.
+        '''
+        phases = self._plan_phases()
+        if self.plan_index is None:
+            self.plan_index = PlanIndex(phases)
+        return phases, self.plan_index
+
+    def _plan_phases(self):
+        # The task assertions run by run_assertions() share one reading of
+        # the plan
+        if self.batch_phases is not None:
+            return self.batch_phases
+        return self.execution.plan_phases()
+
     def _find_config_task_loose(self, hostname, call_type, call_id, vpath,
             *arglist):
         return self._find_config_task(hostname, call_type, call_id, vpath,
@@ -1480,68 +1931,41 @@ can only contain tasks for the same node"
             _kwargs_search_method = self._task_has_kwargs_strict
         else:
             _kwargs_search_method = self._task_has_kwargs
-        for p, phase in enumerate(self.execution.plan_phases()):
-            for t, task in enumerate(phase):
-                if type(task) is ConfigTask and \
-                        task.call_type == call_type and \
-                        task.call_id == call_id and \
-                        vpath == task._model_item_vpath and \
-                        self._check_hostname(task, hostname) and \
-                        _kwargs_search_method(task, arglist):
-                    return (task, p, t)
+        phases, index = self._plan_tasks()
+        for p, t in index.tasks.get(
+                (ConfigTask, call_type, call_id, vpath), []):
+            task = phases[p][t]
+            if self._check_hostname(task, hostname) and \
+                    _kwargs_search_method(task, arglist, (p, t)):
+                return (task, p, t)
 
     def _get_number_config_tasks(self, hostname):
-        number_of_config_tasks = 0
-        for phase in self.execution.plan_phases():
-            for task in phase:
-                if type(task) is ConfigTask and self._check_hostname(
-                        task, hostname):
-                    number_of_config_tasks += 1
-        return number_of_config_tasks
+        return self._plan_tasks()[1].config_tasks.get(hostname, 0)
 
     def _get_number_callback_tasks(self):
-        number_of_callback_tasks = 0
-        for phase in self.execution.plan_phases():
-            for task in phase:
-                if type(task) is CallbackTask:
-                    number_of_callback_tasks += 1
-        return number_of_callback_tasks
+        return self._plan_tasks()[1].callback_tasks
 
     def _get_lock_unlock_tasks(self, hostname):
-        lock_tasks = 0
-        unlock_tasks = 0
-        for phase in self.execution.plan_phases():
-            for task in phase:
-                if (not isinstance(task.model_item, basestring) and
-                    getattr(task.model_item, 'hostname', '') == hostname):
-                    if task.lock_type == task.TYPE_LOCK:
-                        lock_tasks += 1
-                    if task.lock_type == task.TYPE_UNLOCK:
-                        unlock_tasks += 1
-        return lock_tasks, unlock_tasks
+        return self._plan_tasks()[1].lock_tasks.get(hostname, (0, 0))
 
     def _find_callback_task(self, call_method, vpath,
             *arglist):
-        for p, phase in enumerate(self.execution.plan_phases()):
-            for t, task in enumerate(phase):
-                if type(task) is CallbackTask and \
-                        task.call_type == call_method and \
-                        vpath == task._model_item_vpath and \
-                        self._task_has_pargs(task, arglist) and \
-                        self._task_has_kwargs(task, arglist):
-                    return (task, p, t)
+        phases, index = self._plan_tasks()
+        for p, t in index.tasks.get(
+                (CallbackTask, call_method, None, vpath), []):
+            task = phases[p][t]
+            if self._task_has_pargs(task, arglist, (p, t)) and \
+                    self._task_has_kwargs(task, arglist, (p, t)):
+                return (task, p, t)
 
     def _find_remote_execution_task(self,
             item_vpath, node_hostname, agent, action):
-        for p, phase in enumerate(self.execution.plan_phases()):
-            for t, task in enumerate(phase):
-                if type(task) is RemoteExecutionTask and \
-                        item_vpath == task._model_item_vpath and \
-                        any(node.hostname == node_hostname
-                                for node in task.nodes) and \
-                        agent == task.agent and \
-                        action == task.action:
-                    return (task, p, t)
+        phases, index = self._plan_tasks()
+        for p, t in index.remote_tasks.get((item_vpath, action), []):
+            task = phases[p][t]
+            if any(node.hostname == node_hostname for node in task.nodes) \
+                    and agent == task.agent:
+                return (task, p, t)
 
     def _find_remote_execution_task_in_phase(
             self, phase, item_vpath, node_hostname, agent, action):
@@ -1796,13 +2220,10 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
             assertRemoteTask ping \
 /deployments/local_vm/clusters/cluster1/nodes/node1
         '''
-        for phase in self.execution.plan_phases():
-            for task in phase:
-                if type(task) is RemoteExecutionTask and \
-                        task.action == action and \
-                        vpath == task._model_item_vpath and \
-                        self._task_has_kwargs(task, arglist):
-                    return "Pass"
+        phases, index = self._plan_tasks()
+        for p, t in index.remote_tasks.get((vpath, action), []):
+            if self._task_has_kwargs(phases[p][t], arglist, (p, t)):
+                return "Pass"
         raise AssertionError("No such RemoteExecutionTask in plan %s %s" % (
             action, vpath))
 
@@ -1898,11 +2319,10 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
 
             assertTaskInPlan nfs::configure /infrastructure/shares/nfs
         '''
-        for phase in self.execution.plan_phases():
-            for task in phase:
-                if task.call_type == call_type and \
-                    item_vpath == task._model_item_vpath:
-                    return "Pass"
+        phases, index = self._plan_tasks()
+        for p, t in index.calls.get(call_type, []):
+            if item_vpath == phases[p][t]._model_item_vpath:
+                return "Pass"
         raise AssertionError("No such task in plan: %s %s" % (call_type,
             item_vpath))
 
@@ -2029,16 +2449,16 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
         referred_tasks[task._id] = coll_attr
 
     def find_config_task_in_plan(self, call_type, node_hostname, item_vpath):
-        for phase in self.execution.plan.phases:
-            for task in phase:
-                if not isinstance(task, ConfigTask):
-                    continue
-                if (
-                    task.call_type == call_type and
-                    task.get_node().hostname == node_hostname and
-                    task.item_vpath == item_vpath
-                ):
-                    return task
+        phases, index = self._plan_tasks()
+        for p, t in index.calls.get(call_type, []):
+            task = phases[p][t]
+            if not isinstance(task, ConfigTask):
+                continue
+            if (
+                task.get_node().hostname == node_hostname and
+                task.item_vpath == item_vpath
+            ):
+                return task
 
     def command_fail_config_task(self, call_type, node_hostname, item_vpath):
         '''
@@ -2096,15 +2516,14 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
         self.remove_failed_task(task)
 
     def find_callback_task_in_plan(self, method_name, item_vpath):
-        for phase in self.execution.plan.phases:
-            for task in phase:
-                if not isinstance(task, CallbackTask):
-                    continue
-                if (
-                    task.call_type == method_name and
-                    task.item_vpath == item_vpath
-                ):
-                    return task
+        phases, index = self._plan_tasks()
+        for p, t in index.calls.get(method_name, []):
+            task = phases[p][t]
+            if (
+                isinstance(task, CallbackTask) and
+                task.item_vpath == item_vpath
+            ):
+                return task
 
     def command_disable_callback_mock(self, method_name, item_vpath):
         '''
@@ -2205,80 +2624,95 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
                     key, value, task.kwargs[key]))
         return True
 
-    def _unify_kwargs(self, assert_args, task):
-        def eval_value(val):
-            if isinstance(val, FuturePropertyValue):
-                return val.value
-            elif isinstance(val, list):
-                return [eval_value(i) for i in val]
-            elif isinstance(val, dict):
-                return dict((k, eval_value(v)) for (k, v) in val.iteritems())
-            return val
-
-        unescape = lambda val: val.replace(r'\n', '\n').replace(r'\#', r'#')
-        kwargs = [arg.split('=', 1) for arg in assert_args if '=' in arg]
-        kwargs = [(key, self._safe_read_json(unescape(val)))
-                for (key, val) in kwargs]
-        kwargs = dict(kwargs)
-        task_kwargs = [(key, eval_value(self._safe_read_json(val)))
-                for (key, val) in task.kwargs.items()]
-        task_kwargs = dict(task_kwargs)
+    def _unify_kwargs(self, assert_args, task, position=None):
+        kwargs = self._assertion_args('kwargs', assert_args,
+                                      self._read_assertion_kwargs)
+        task_kwargs = self._task_args('kwargs', task, position,
+                                      self._read_task_kwargs)
         return kwargs, task_kwargs
 
-    def _unify_pargs(self, assert_args, task):
-        def eval_value(val):
-            if isinstance(val, FuturePropertyValue):
-                return val.value
-            elif isinstance(val, list):
-                return [eval_value(i) for i in val]
-            elif isinstance(val, dict):
-                return dict((k, eval_value(v)) for (k, v) in val.iteritems())
-            return val
-
-        unescape = lambda val: val.replace(r'\n', '\n').replace(r'\#', r'#')
-        pargs = [arg for arg in assert_args if '=' not in arg]
-        pargs = tuple([
-            self._safe_read_json(unescape(parg)) for parg in pargs
-        ])
-
-        task_pargs = tuple([
-            eval_value(self._safe_read_json(arg)) for arg in task.args
-        ])
+    def _unify_pargs(self, assert_args, task, position=None):
+        pargs = self._assertion_args('pargs', assert_args,
+                                     self._read_assertion_pargs)
+        task_pargs = self._task_args('pargs', task, position,
+                                     self._read_task_pargs)
         return pargs, task_pargs
 
-    def _task_has_pargs(self, task, args):
+    def _assertion_args(self, kind, assert_args, read_args):
+        '''
+        Returns the arguments of the current assertion command as read by
+        read_args, which only reads them once per command.
+        '''
+        key = (kind, tuple(assert_args))
+        if key not in self.assertion_args:
+            self.assertion_args[key] = read_args(assert_args)
+        return self.assertion_args[key]
+
+    def _task_args(self, kind, task, position, read_args):
+        '''
+        Returns the arguments of a task as read by read_args. For a task
+        found through the plan index, at the given (phase, index) position,
+        they are only read once for as long as the index is kept, since
+        future property values cannot change in the meantime.
+        '''
+        if position is None or self.plan_index is None:
+            return read_args(task)
+        task_args = self.plan_index.task_args
+        key = (kind,) + position
+        if key not in task_args:
+            task_args[key] = read_args(task)
+        return task_args[key]
+
+    def _read_assertion_kwargs(self, assert_args):
+        kwargs = [arg.split('=', 1) for arg in assert_args if '=' in arg]
+        return dict((key, self._safe_read_json(_unescape(val)))
+                    for (key, val) in kwargs)
+
+    def _read_assertion_pargs(self, assert_args):
+        return tuple([self._safe_read_json(_unescape(parg))
+                      for parg in assert_args if '=' not in parg])
+
+    def _read_task_kwargs(self, task):
+        return dict((key, _eval_value(self._safe_read_json(val)))
+                    for (key, val) in task.kwargs.items())
+
+    def _read_task_pargs(self, task):
+        return tuple([_eval_value(self._safe_read_json(arg))
+                      for arg in task.args])
+
+    def _task_has_pargs(self, task, args, position=None):
         # This applies only to callback tasks
-        args, task_args = self._unify_pargs(args, task)
+        args, task_args = self._unify_pargs(args, task, position)
         # Not all assertions provide the expected positional arguments. In that
         # case, we don't want to fail the assertion
         if not args:
             return True
         return args == task_args
 
-    def _task_has_kwargs(self, task, args):
-        kwargs, task_kwargs = self._unify_kwargs(args, task)
+    def _task_has_kwargs(self, task, args, position=None):
+        kwargs, task_kwargs = self._unify_kwargs(args, task, position)
         for key in kwargs:
-            if key not in task_kwargs:
-                if "." in key:
-                    try:
-                        key_path = key.split(".")
-                        value = reduce(dict.__getitem__, key_path[1:],
-                                task_kwargs[key_path[0]])
-                        task_kwargs[key] = value
-                    except ValueError:
-                        return False
-                else:
+            if key in task_kwargs:
+                value = task_kwargs[key]
+            elif "." in key:
+                try:
+                    key_path = key.split(".")
+                    value = reduce(dict.__getitem__, key_path[1:],
+                            task_kwargs[key_path[0]])
+                except ValueError:
                     return False
-            if kwargs[key] != task_kwargs[key]:
+            else:
+                return False
+            if kwargs[key] != value:
                 return False
         return True
 
-    def _task_has_kwargs_strict(self, task, args):
+    def _task_has_kwargs_strict(self, task, args, position=None):
         ''' Verify if task has exactly the same kwargs as passed in - both
         value-wise and length-wise.
 
         '''
-        kwargs, task_kwargs = self._unify_kwargs(args, task)
+        kwargs, task_kwargs = self._unify_kwargs(args, task, position)
         if kwargs == task_kwargs:
             return True
         return False
@@ -2290,16 +2724,15 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
             return msg
 
     def _copy_actual_to_expected(self, actual, expected):
-        for filename in self.filesystem._files.keys():
-            if filename.startswith(actual):
-                expected_filename = os.path.join(
-                    expected, filename[len(actual):]
-                )
-                self._save_file(
-                    expected_filename,
-                    self.filesystem.mock_open(filename).read()
-                )
-                print "Updated expected file %s" % (expected_filename,)
+        for filename in self.filesystem.files_under(actual):
+            expected_filename = os.path.join(
+                expected, filename[len(actual):]
+            )
+            self._save_file(
+                expected_filename,
+                self.filesystem.mock_open(filename).read()
+            )
+            print "Updated expected file %s" % (expected_filename,)
 
     def _run_plan_until(self, phase_index):
         if self.execution.plan.is_initial():
@@ -2397,6 +2830,9 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
         '''
         conf_dir = self._local(plugin_conf_dir)
         sys.path.append(conf_dir)
+        # The snapshotted plugin manager and database rows are about to
+        # include plugins that are not part of the baseline
+        self.landscape_snapshot = None
         self.plugin_manager.add_plugins(conf_dir)
         update_plugins(scope.data_manager, self.plugin_manager)
         if not hasattr(self.plugin_manager, "_added_plugin_paths"):
@@ -2412,6 +2848,9 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
         '''
         conf_dir = self._local(ext_conf_dir)
         sys.path.append(conf_dir)
+        # The snapshotted plugin manager and database rows are about to
+        # include extensions that are not part of the baseline
+        self.landscape_snapshot = None
         self.plugin_manager.add_extensions(conf_dir)
         update_plugins(scope.data_manager, self.plugin_manager)
         self.extra_extensions.append(conf_dir)
@@ -2424,7 +2863,7 @@ dictionary like dict = {a : {b : {c : 5, d : 7} } }
         if self.filesystem.mock_exists(self.args.file):
             return self.filesystem.mock_open(self.args.file).read()
         else:
-            return open(self._local(self.args.file)).read()
+            return self._read_real_file(self._local(self.args.file))
 
     def _save_file(self, filename, contents):
         dirname = os.path.dirname(self._local(filename))
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+from collections import namedtuple
+
+
+# Bumped whenever the way scripts are compiled changes, so that scripts
+# compiled by an earlier version are not read back from a cache directory
+FORMAT_VERSION = 1
+
+# ATs run by runats
+AT_SCRIPT = 'at'
+# Scripts included with runLitpScript, which have always been read with
+# slightly different rules
+INCLUDED_SCRIPT = 'include'
+
+# Hash (#) indicates a comment unless it's escaped with a '\'.
+comment = re.compile(r'(?<!\\)#')
+
+# Scripts compiled in this process, by the hash of their source
+_compiled_scripts = {}
+
+# Task assertions that only read the plan, so that a run of them can be
+# checked against a single reading of it
+BATCHED_ASSERTIONS = frozenset([
+    'assertTask', 'assertConfigTask', 'assertNoConfigTask',
+    'assertCallbackTask', 'assertNoCallbackTask', 'assertRemoteTask',
+    'assertNumberConfigTasks', 'assertNumberCallbackTasks',
+])
+
+
+class ScriptLine(namedtuple('ScriptLine', 'line command args error')):
+    '''
+    A command in a compiled script, along with the source line it ends on.
+    Lines that cannot be tokenized are kept with the error raised for them,
+    so that it is raised when the script reaches them rather than before the
+    script starts running.
+    '''
+
+
+class ScriptBatch(namedtuple('ScriptBatch', 'lines')):
+    '''
+    A run of consecutive task assertions in a compiled script, which are
+    checked against a single reading of the plan.
+    '''
+
+
+def _at_script_lines(text):
+    # Iterating over a file splits it after each '\n', keeping it
+    lines = text.split('\n')
+    last_line = lines.pop()
+    for line in lines:
+        yield line + '\n'
+    if last_line:
+        yield last_line
+
+
+def _parse(text, dialect):
+    if dialect == AT_SCRIPT:
+        lines = _at_script_lines(text)
+        continuation = "\\\n"
+    else:
+        lines = text.split("\n")
+        continuation = "\\"
+
+    line_number = 0
+    previous_line = ''
+    for line in lines:
+        line_number += 1
+        if line.endswith(continuation):
+            previous_line += line.split(continuation)[0]
+            continue
+        if previous_line:
+            line = previous_line + line
+            previous_line = ''
+        if dialect == AT_SCRIPT:
+            line = comment.split(line)[0]
+        else:
+            line = line.split("#")[0]
+            if line.startswith('../'):
+                line = 'runLitpScript ' + line
+        try:
+            args = shlex.split(line)
+        except ValueError as ex:
+            yield ScriptLine(line_number, None, None, str(ex))
+            continue
+        if args:
+            yield ScriptLine(line_number, args[0], args[1:], None)
+
+
+def compile_script(text, dialect=AT_SCRIPT, cache_dir=None):
+    '''
+    Splits a script into its commands, each already tokenized. Scripts are
+    compiled once per process, and once in all if a cache directory is
+    given, for any given source and dialect.
+    '''
+    digest = hashlib.sha1('%s\0%s\0%s' % (FORMAT_VERSION, dialect,
+                                          text)).hexdigest()
+    if digest in _compiled_scripts:
+        return _compiled_scripts[digest]
+
+    script = None
+    if cache_dir is not None:
+        script = _load(cache_dir, digest)
+    if script is None:
+        script = list(_parse(text, dialect))
+        if cache_dir is not None:
+            try:
+                _save(cache_dir, digest, script)
+            except UnicodeDecodeError:
+                # Scripts that are not valid UTF-8 are only compiled in
+                # memory
+                pass
+    _compiled_scripts[digest] = script
+    return script
+
+
+def batch_assertions(script):
+    '''
+    Yields the lines of a compiled script, with every run of two or more
+    consecutive task assertions in BATCHED_ASSERTIONS grouped into a
+    ScriptBatch.
+    '''
+    batch = []
+    for script_line in script:
+        if script_line.command in BATCHED_ASSERTIONS:
+            batch.append(script_line)
+            continue
+        for entry in _flush_batch(batch):
+            yield entry
+        batch = []
+        yield script_line
+    for entry in _flush_batch(batch):
+        yield entry
+
+
+def _flush_batch(batch):
+    if len(batch) > 1:
+        return [ScriptBatch(batch)]
+    return batch
+
+
+def _cache_path(cache_dir, digest):
+    return os.path.join(cache_dir, digest + '.json')
+
+
+def _load(cache_dir, digest):
+    try:
+        with open(_cache_path(cache_dir, digest)) as cached_file:
+            lines = json.load(cached_file)
+    except (IOError, ValueError):
+        return None
+    # Commands are run with the byte strings that shlex returns
+    return [ScriptLine(line, _encode(command),
+                       [_encode(arg) for arg in args] if args is not None
+                       else None, _encode(error))
+            for line, command, args, error in lines]
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _save(cache_dir, digest, script):
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Another AT process may have created it in the meantime
+            if not os.path.isdir(cache_dir):
+                raise
+    contents = json.dumps(script)
+    cache_path = _cache_path(cache_dir, digest)
+    tmp_path = "%s.%d.tmp" % (cache_path, os.getpid())
+    with open(tmp_path, 'w') as cached_file:
+        cached_file.write(contents)
+    os.rename(tmp_path, cache_path)
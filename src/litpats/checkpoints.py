@@ -0,0 +1,63 @@
+import cPickle
+import hashlib
+import os
+
+
+def checkpoint_key(*parts):
+    '''
+    Returns a hash identifying a checkpoint by everything its state depends
+    on.
+    '''
+    digest = hashlib.sha1()
+    for part in parts:
+        part = repr(part)
+        digest.update('%d\0%s' % (len(part), part))
+    return digest.hexdigest()
+
+
+class CheckpointStore(object):
+    '''
+    Keeps pickled checkpoints in a directory, one file per checkpoint named
+    after its key, so that processes sharing the directory can restore the
+    checkpoints taken by any of them.
+
+    Checkpoints are also kept in memory once they have been saved or loaded
+    in this process.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._checkpoints = {}
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.pickle')
+
+    def load(self, key):
+        '''
+        Returns the checkpoint saved with the given key, or None if there is
+        none.
+        '''
+        if key not in self._checkpoints:
+            try:
+                with open(self._path(key), 'rb') as checkpoint_file:
+                    self._checkpoints[key] = cPickle.load(checkpoint_file)
+            except IOError:
+                return None
+        return self._checkpoints[key]
+
+    def save(self, key, checkpoint):
+        '''
+        Saves the checkpoint, unless it cannot be pickled. Returns whether it
+        was saved.
+        '''
+        try:
+            contents = cPickle.dumps(checkpoint, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return False
+        path = self._path(key)
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as checkpoint_file:
+            checkpoint_file.write(contents)
+        os.rename(tmp_path, path)
+        self._checkpoints[key] = checkpoint
+        return True
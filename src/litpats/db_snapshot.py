@@ -0,0 +1,54 @@
+from sqlalchemy import MetaData
+
+
+class DbSnapshot(object):
+    '''
+    In-memory copy of the rows held in every table of a database.
+
+    The tables are discovered by reflection, so a snapshot can be taken of
+    whatever schema core has created without depending on its model.
+    '''
+
+    def __init__(self, metadata, rows):
+        self._metadata = metadata
+        self._rows = rows
+
+    @classmethod
+    def take(cls, engine):
+        metadata = MetaData()
+        metadata.reflect(bind=engine)
+        rows = {}
+        connection = engine.connect()
+        try:
+            for table in metadata.sorted_tables:
+                rows[table.name] = [
+                    dict(row) for row in connection.execute(table.select())]
+        finally:
+            connection.close()
+        return cls(metadata, rows)
+
+    def __getstate__(self):
+        # Only the rows are pickled: the tables are reflected again from the
+        # database the snapshot is restored to
+        return {'_rows': self._rows}
+
+    def __setstate__(self, state):
+        self._metadata = None
+        self._rows = state['_rows']
+
+    def restore(self, engine):
+        '''
+        Replaces the contents of the snapshotted tables with the rows they
+        held when the snapshot was taken, in a single transaction.
+        '''
+        if self._metadata is None:
+            self._metadata = MetaData()
+            self._metadata.reflect(bind=engine)
+        tables = self._metadata.sorted_tables
+        with engine.begin() as connection:
+            for table in reversed(tables):
+                connection.execute(table.delete())
+            for table in tables:
+                rows = self._rows[table.name]
+                if rows:
+                    connection.execute(table.insert(), rows)
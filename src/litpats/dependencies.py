@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import sys
+
+
+def _file_digest(path):
+    try:
+        with open(path, 'rb') as dep_file:
+            return hashlib.sha1(dep_file.read()).hexdigest()
+    except IOError:
+        return None
+
+
+class DependencyStore(object):
+    '''
+    Records the files, with their hashes, that each AT depended on the last
+    time it passed, so that ATs none of whose dependencies have changed since
+    then can be skipped.
+
+    Every AT's record is kept in a JSON file of its own in ``directory``, so
+    that ATs run concurrently can record their dependencies independently.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._digests = {}
+
+    def _record_path(self, at_path):
+        key = hashlib.sha1(os.path.abspath(at_path)).hexdigest()
+        return os.path.join(self.directory, key + '.json')
+
+    def _digest(self, path):
+        # Files are not expected to change while ATs are running
+        if path not in self._digests:
+            self._digests[path] = _file_digest(path)
+        return self._digests[path]
+
+    def is_stale(self, at_path):
+        '''
+        Returns whether the AT has to be run: because it has not passed yet,
+        or because one of the files it depended on has changed since.
+        '''
+        try:
+            with open(self._record_path(at_path)) as record_file:
+                digests = json.load(record_file)
+        except (IOError, ValueError):
+            return True
+        for path, digest in digests.iteritems():
+            if self._digest(path) != digest:
+                return True
+        return False
+
+    def record(self, at_path, paths):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Another AT process may have created it in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+        digests = {}
+        for path in set(paths) | set([os.path.abspath(at_path)]):
+            digest = _file_digest(path)
+            # Files that are gone by the end of the AT were only temporary
+            if digest is not None:
+                digests[path] = digest
+
+        record_path = self._record_path(at_path)
+        tmp_path = "%s.%d.tmp" % (record_path, os.getpid())
+        with open(tmp_path, 'w') as record_file:
+            json.dump(digests, record_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, record_path)
+
+    def forget(self, at_path):
+        try:
+            os.remove(self._record_path(at_path))
+        except OSError:
+            pass
+
+
+class DependencyTracker(object):
+    '''
+    Collects the Python source files that are executed or imported while it
+    is running, using the same coverage collector as ``--cover-packages``,
+    along with any other files reported to it.
+    '''
+
+    def __init__(self):
+        import coverage
+        self._collector = coverage.coverage()
+        self._modules = set()
+        self.paths = set()
+
+    def start(self):
+        self._modules = set(sys.modules)
+        self._collector.start()
+
+    def stop(self):
+        self._collector.stop()
+        if hasattr(self._collector, 'get_data'):
+            data = self._collector.get_data()
+        else:
+            data = self._collector.data
+        self.paths.update(os.path.abspath(path)
+                          for path in data.measured_files())
+        for name in set(sys.modules) - self._modules:
+            source = self._module_source(sys.modules[name])
+            if source is not None:
+                self.paths.add(source)
+
+    @staticmethod
+    def _module_source(module):
+        path = getattr(module, '__file__', None)
+        if not path:
+            return None
+        if path.endswith(('.pyc', '.pyo')):
+            path = path[:-1]
+        return os.path.abspath(path)
+
+    def add_path(self, path):
+        self.paths.add(os.path.abspath(path))
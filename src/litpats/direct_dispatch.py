@@ -0,0 +1,100 @@
+import posixpath
+from collections import namedtuple
+
+
+# The LITP commands that can be sent straight to the REST API, with the
+# options each of them accepts in direct dispatch. Anything else, including
+# the long forms of these options, goes through the LITP CLI as usual.
+COMMAND_OPTIONS = {
+    'create': set(['-p', '-t', '-o']),
+    'inherit': set(['-p', '-s', '-o']),
+    'update': set(['-p', '-o']),
+    'remove': set(['-p']),
+    'create_plan': set(),
+    'show': set(['-p']),
+}
+
+# The options each command cannot do without
+REQUIRED_OPTIONS = {
+    'create': set(['-p', '-t']),
+    'inherit': set(['-p', '-s']),
+    'update': set(['-p', '-o']),
+    'remove': set(['-p']),
+    'create_plan': set(),
+    'show': set(['-p']),
+}
+
+
+class DirectRequest(namedtuple('DirectRequest', 'method path body')):
+    '''
+    A REST request equivalent to a LITP command. The body is None for
+    requests that do not have one.
+    '''
+
+
+def _parse_options(args, allowed):
+    options = {}
+    index = 0
+    while index < len(args):
+        option = args[index]
+        if option not in allowed or option in options:
+            return None
+        index += 1
+        values = []
+        while index < len(args) and not args[index].startswith('-'):
+            values.append(args[index])
+            index += 1
+        if option == '-o':
+            if not values or any('=' not in value for value in values):
+                return None
+            options[option] = dict(value.split('=', 1) for value in values)
+        elif len(values) == 1:
+            options[option] = values[0]
+        else:
+            return None
+    return options
+
+
+def _split_path(path):
+    parent, item_id = posixpath.split(path)
+    if not item_id:
+        return None, None
+    return parent, item_id
+
+
+def direct_request(args):
+    '''
+    Returns the REST request a LITP command maps to, or None if the command
+    has to go through the LITP CLI, which is always the case when its
+    arguments are not exactly as expected.
+    '''
+    if not args or args[0] not in COMMAND_OPTIONS:
+        return None
+    command = args[0]
+    options = _parse_options(args[1:], COMMAND_OPTIONS[command])
+    if options is None or not REQUIRED_OPTIONS[command] <= set(options):
+        return None
+    path = options.get('-p')
+    if path is not None and not path.startswith('/'):
+        return None
+
+    if command == 'create_plan':
+        return DirectRequest('POST', '/plans', {'id': 'plan', 'type': 'plan'})
+    if command == 'show':
+        return DirectRequest('GET', path, None)
+    if command == 'remove':
+        return DirectRequest('DELETE', path, None)
+    if command == 'update':
+        return DirectRequest('PUT', path, {'properties': options['-o']})
+
+    parent, item_id = _split_path(path)
+    if item_id is None:
+        return None
+    body = {'id': item_id}
+    if command == 'create':
+        body['type'] = options['-t']
+    else:
+        body['inherit'] = options['-s']
+    if '-o' in options:
+        body['properties'] = options['-o']
+    return DirectRequest('POST', parent, body)
@@ -7,6 +7,35 @@ import cherrypy
 from cherrypy._cpreqbody import RequestBody
 
 
+_LITP_URL = re.compile(r'https://localhost:9999/litp(/xml|/rest/v1)?')
+
+# How many URLs the results of parsing them are remembered for
+PARSED_URLS_CACHE_SIZE = 4096
+
+# The path info, query string and request parameters of recently requested
+# URLs
+_parsed_urls = {}
+
+# The parts of the WSGI environ that are the same for every request
+_WSGI_ENVIRON = {
+    'SERVER_PORT': '9999', 'SERVER_PROTOCOL': 'HTTP/1.1',
+    'SERVER_SOFTWARE': 'CherryPy/3.2.2 Server',
+    'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1',
+    'HTTP_HOST': 'localhost:9999',
+    'HTTPS': 'on',
+    'wsgi.multithread': False,
+    'SSL_CIPHER': 'AES256-SHA',
+    'REMOTE_ADDR': '127.0.0.1',
+    'HTTP_ACCEPT': '*/*',
+    'wsgi.version': (1, 0),
+    'SERVER_NAME': '0.0.0.0',
+    'wsgi.run_once': False,
+    'SSL_PROTOCOL': 'TLSv1/SSLv3',
+    'wsgi.multiprocess': False,
+    'wsgi.url_scheme': 'https',
+}
+
+
 class MockHTTPResponse(object):
     def __init__(self, text):
         self.text = text
@@ -25,35 +54,35 @@ class MockHTTPConnection(object):
         self.response = None
 
     def _wsgi_environ(self, url):
-        return {
+        path_info, query_string, _ = self._parse_url(url)
+        environ = dict(_WSGI_ENVIRON)
+        environ.update({
             'REQUEST_METHOD': cherrypy.request.method,
-            'SERVER_PORT': '9999', 'SERVER_PROTOCOL': 'HTTP/1.1',
-            'SERVER_SOFTWARE': 'CherryPy/3.2.2 Server',
-            'ACTUAL_SERVER_PROTOCOL': 'HTTP/1.1',
-            'HTTP_HOST': 'localhost:9999',
-            'PATH_INFO': self._extract_path_info(url),
-            'HTTPS': 'on',
+            'PATH_INFO': path_info,
             'REQUEST_URI': url,
-            'wsgi.multithread': False,
-            'QUERY_STRING': self._extract_querystring(url),
-            'SSL_CIPHER': 'AES256-SHA',
-            'REMOTE_ADDR': '127.0.0.1',
-            'HTTP_ACCEPT': '*/*',
-            'wsgi.version': (1, 0),
-            'SERVER_NAME': '0.0.0.0',
-            'wsgi.run_once': False,
-            'SSL_PROTOCOL': 'TLSv1/SSLv3',
-            'wsgi.multiprocess': False,
-            'wsgi.url_scheme': 'https',
+            'QUERY_STRING': query_string,
             'CONTENT_TYPE': cherrypy.request.headers.get(
                 'Content-Type', 'text/plain'),
             'CONTENT_LENGTH': cherrypy.request.headers.get(
                 'Content-Length', 0),
-        }
+        })
+        return environ
+
+    def _parse_url(self, url):
+        parsed_url = _parsed_urls.get(url)
+        if parsed_url is None:
+            if len(_parsed_urls) >= PARSED_URLS_CACHE_SIZE:
+                _parsed_urls.clear()
+            parsed_url = _parsed_urls[url] = (
+                self._extract_path_info(url),
+                self._extract_querystring(url),
+                self._extract_request_params(url))
+        return parsed_url
 
     def request(self, method, url, body=None, headers=None):
+        path_info, query_string, params = self._parse_url(url)
         cherrypy.serving.request.params = {}
-        cherrypy.request.query_string = self._extract_querystring(url)
+        cherrypy.request.query_string = query_string
         cherrypy.request.method = method
         cherrypy.request.headers.update(headers)
 
@@ -66,9 +95,7 @@ class MockHTTPConnection(object):
                                             cherrypy.request.headers)
         cherrypy.request.wsgi_environ = self._wsgi_environ(url)
 
-        cherrypy.serving.request.params.update(
-            self._extract_request_params(url))
-        path_info = self._extract_path_info(url)
+        cherrypy.serving.request.params.update(params)
 
         if headers.get('Content-Type') == 'application/xml':
             self.response = MockHTTPResponse(self._get_xml_response(path_info))
@@ -97,8 +124,7 @@ class MockHTTPConnection(object):
         if url == 'https://localhost:9999/litp/upgrade':
             return '/litp/upgrade'
         else:
-            return re.sub(
-                    r'https://localhost:9999/litp(/xml|/rest/v1)?', '', url)
+            return _LITP_URL.sub('', url)
 
     def getresponse(self):
         return self.response
@@ -117,7 +143,7 @@ class MockHTTPConnection(object):
         return app.config['/']['request.dispatch']
 
     def _get_xml_response(self, url):
-        dispatcher = self._get_xml_dispatcher(self._extract_path_info(url))
+        dispatcher = self._get_xml_dispatcher(self._parse_url(url)[0])
         dispatcher(url)
         return cherrypy.request.handler()
 
@@ -1,9 +1,9 @@
 import __builtin__
 import os
+import stat
 import grp
 import shutil
 import errno
-import copy
 import fcntl
 
 from litpats import default_files
@@ -15,17 +15,58 @@ from collections import namedtuple
 
 ALLOWED_FILES = ['/dev/null']
 
+# How many paths is_real_path_hidden() remembers its answer for
+HIDDEN_PATHS_CACHE_SIZE = 4096
+
+# Contents of the real files read into mocked files, by path, along with the
+# modification time and size they were read at. Identical contents are
+# shared by all the files that have them.
+_real_file_contents = {}
+_contents_pool = {}
+
+# The mocked files that every mock filesystem starts with, by root path
+_baseline_files = {}
+
+
+def _intern_contents(contents):
+    return _contents_pool.setdefault(contents, contents)
+
 
 class MockFile(object):
+    '''
+    A mocked file's contents, kept as a list of chunks that are joined into
+    a single string when the contents are read. Since strings are immutable,
+    copies of a file share its contents until either of them is written to.
+
+    The contents are line-oriented: every write starts a new line. A file
+    with no lines and a file with a single empty line both have empty
+    contents, so which of the two a file holds is tracked separately.
+
+    A file created with ``lazy()`` only gets its contents from its loader
+    when they are first needed. The path the loader mocks it at, if any, is
+    kept too.
+    '''
+
     def __init__(self, contents=None):
-        if contents:
-            self.lines = contents.split("\n")
-        else:
-            self.lines = []
+        self._set_contents(contents)
+        self._loader = None
+        self._overlay_path = None
         self._closed = True
         self._name = ''
         self._mode = 'r'
 
+    @classmethod
+    def lazy(cls, loader, overlay_path=None):
+        mock_file = cls()
+        mock_file._loader = loader
+        mock_file._overlay_path = overlay_path
+        return mock_file
+
+    def _load(self):
+        if self._loader is not None:
+            loader, self._loader = self._loader, None
+            self._set_contents(loader())
+
     def __repr__(self):
         state = 'closed' if self._closed else 'open'
         return "<{0} {1} {2}, mode '{3}' at {4}".format(
@@ -72,8 +113,75 @@ class MockFile(object):
     def close(self):
         self._closed = True
 
+    def _set_contents(self, contents, has_lines=None):
+        self._chunks = [contents] if contents else []
+        self._size = len(contents) if contents else 0
+        self._has_lines = bool(contents) if has_lines is None else has_lines
+        self._line_offsets = None
+
+    @property
+    def lines(self):
+        self._load()
+        if not self._has_lines:
+            return []
+        return self.dump().split("\n")
+
+    @lines.setter
+    def lines(self, lines):
+        self._loader = None
+        self._set_contents("\n".join(lines), bool(lines))
+
+    @property
+    def size(self):
+        self._load()
+        return self._size
+
+    def copy(self):
+        if self._loader is not None:
+            return MockFile.lazy(self._loader)
+        mock_file = MockFile()
+        mock_file._set_contents(self.dump(), self._has_lines)
+        return mock_file
+
     def dump(self):
-        return "\n".join(self.lines)
+        self._load()
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0] if self._chunks else ''
+
+    def append_line(self, line):
+        self._load()
+        if self._has_lines:
+            self._chunks.append("\n")
+            self._size += 1
+        if line:
+            self._chunks.append(line)
+            self._size += len(line)
+        self._has_lines = True
+        self._line_offsets = None
+
+    def truncate(self, size):
+        self._load()
+        if size < self._size:
+            self._set_contents(self.dump()[:size], size > 0)
+
+    def line_offsets(self):
+        '''
+        Returns the offset at which each line starts.
+        '''
+        self._load()
+        if self._line_offsets is None:
+            offsets = []
+            if self._has_lines:
+                contents = self.dump()
+                offset = 0
+                while offset != -1:
+                    offsets.append(offset)
+                    offset = contents.find("\n", offset)
+                    if offset != -1:
+                        offset += 1
+            self._line_offsets = offsets
+        return self._line_offsets
 
 
 class MockBuffer(object):
@@ -127,22 +235,27 @@ class MockBuffer(object):
         elif os.SEEK_CUR == whence:
             self.offset_pointer += offset
         elif os.SEEK_END == whence:
-            self.offset_pointer = len(self.mock_file.dump()) - offset
+            self.offset_pointer = self.mock_file.size + offset
 
     def read(self, size=None):
-        if size:
-            fullfile = self.mock_file.dump()
-            size = min(size, len(fullfile) - self.offset_pointer)
-            segment = fullfile[self.offset_pointer:self.offset_pointer + size]
-            self.offset_pointer += size
+        if size is not None and size >= 0:
+            start = min(self.offset_pointer, self.mock_file.size)
+            segment = self.mock_file.dump()[start:start + size]
+            self.offset_pointer = start + len(segment)
             return segment
-        return "\n".join(self.mock_file.lines)
+        return self.mock_file.dump()
 
     def readline(self):
-        if self.line_pointer < len(self.mock_file.lines):
-            line = self.mock_file.lines[self.line_pointer]
+        line_offsets = self.mock_file.line_offsets()
+        if self.line_pointer < len(line_offsets):
+            start = line_offsets[self.line_pointer]
             self.line_pointer += 1
-            return "%s\n" % (line,)
+            if self.line_pointer < len(line_offsets):
+                end = line_offsets[self.line_pointer] - 1
+            else:
+                end = self.mock_file.size
+            self.offset_pointer = min(end + 1, self.mock_file.size)
+            return "%s\n" % (self.mock_file.dump()[start:end],)
         else:
             return ""
 
@@ -150,20 +263,23 @@ class MockBuffer(object):
         return self.mock_file.lines
 
     def write(self, data):
-        lines = data.split('\n')
-        if lines and lines[-1] == '':
-            lines.pop()
-        self.mock_file.lines.extend(lines)
+        if data.endswith('\n'):
+            data = data[:-1]
+        elif not data:
+            return
+        self.mock_file.append_line(data)
 
     def __iter__(self):
-        for line in list(self.mock_file.lines):
+        for line in self.mock_file.lines:
             yield line
 
     def flush(self):
         pass
 
     def truncate(self, size=None):
-        self.mock_file.lines = self.mock_file.lines[:self.offset_pointer]
+        if size is None:
+            size = self.offset_pointer
+        self.mock_file.truncate(size)
 
 
 def patched_read(self, filenames):
@@ -187,11 +303,162 @@ def patched_read(self, filenames):
     return read_ok
 
 
+def _upstream_paths(filepath):
+    '''
+    Yields the path of every directory above filepath, and filepath itself.
+    An empty path component starts over from the root.
+    '''
+    dirs = []
+    for path_token in filepath.split(os.path.sep):
+        if not path_token:
+            dirs = ['']
+            continue
+        dirs.append(path_token)
+        yield os.path.sep.join(dirs)
+
+
+def _real_stat(path):
+    try:
+        return os.stat(path)
+    except OSError:
+        return None
+
+
+def _parent_dir(filepath):
+    return filepath.rpartition(os.path.sep)[0].rstrip(os.path.sep)
+
+
+class _FileIndex(dict):
+    '''
+    A dictionary of mocked files, keyed by path, that keeps count of the
+    mocked files found under each directory and keeps a tree of the
+    directories holding mocked files, so that neither has to be worked out
+    from every mocked file's path.
+    '''
+
+    def __init__(self, files=()):
+        dict.__init__(self)
+        self._path_refs = {}
+        # Directory tree: the mocked files directly in each directory, the
+        # directories directly in it, and the number of files beneath it
+        self._dir_files = {}
+        self._subdirs = {}
+        self._tree_refs = {}
+        self.update(files)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+    def __setitem__(self, path, mock_file):
+        if path not in self:
+            self._index(path)
+        dict.__setitem__(self, path, mock_file)
+
+    def __delitem__(self, path):
+        dict.__delitem__(self, path)
+        self._unindex(path)
+
+    def pop(self, path, *default):
+        if path in self:
+            mock_file = dict.pop(self, path)
+            self._unindex(path)
+            return mock_file
+        return dict.pop(self, path, *default)
+
+    def popitem(self):
+        path, mock_file = dict.popitem(self)
+        self._unindex(path)
+        return path, mock_file
+
+    def setdefault(self, path, default=None):
+        if path not in self:
+            self[path] = default
+        return self[path]
+
+    def update(self, *args, **kwargs):
+        for path, mock_file in dict(*args, **kwargs).iteritems():
+            self[path] = mock_file
+
+    def clear(self):
+        dict.clear(self)
+        self._path_refs.clear()
+        self._dir_files.clear()
+        self._subdirs.clear()
+        self._tree_refs.clear()
+
+    def _index(self, path):
+        for upstream_path in set(_upstream_paths(path)):
+            self._path_refs[upstream_path] = \
+                self._path_refs.get(upstream_path, 0) + 1
+        dirpath = _parent_dir(path)
+        self._dir_files.setdefault(dirpath, set()).add(path)
+        while True:
+            file_count = self._tree_refs.get(dirpath, 0)
+            self._tree_refs[dirpath] = file_count + 1
+            if not dirpath:
+                break
+            parent_dirpath = _parent_dir(dirpath)
+            if not file_count:
+                self._subdirs.setdefault(parent_dirpath, set()).add(dirpath)
+            dirpath = parent_dirpath
+
+    def _unindex(self, path):
+        for upstream_path in set(_upstream_paths(path)):
+            self._path_refs[upstream_path] -= 1
+            if not self._path_refs[upstream_path]:
+                del self._path_refs[upstream_path]
+        dirpath = _parent_dir(path)
+        self._dir_files[dirpath].discard(path)
+        if not self._dir_files[dirpath]:
+            del self._dir_files[dirpath]
+        while True:
+            self._tree_refs[dirpath] -= 1
+            file_count = self._tree_refs[dirpath]
+            if not file_count:
+                del self._tree_refs[dirpath]
+            if not dirpath:
+                break
+            parent_dirpath = _parent_dir(dirpath)
+            if not file_count:
+                self._subdirs[parent_dirpath].discard(dirpath)
+                if not self._subdirs[parent_dirpath]:
+                    del self._subdirs[parent_dirpath]
+            dirpath = parent_dirpath
+
+    def has_path(self, path):
+        '''
+        Returns whether path is a mocked file or a directory above one.
+        '''
+        return path in self._path_refs
+
+    def has_dir(self, path):
+        return path in self._path_refs and path not in self
+
+    def filenames(self, dirpath):
+        '''
+        Returns the names of the mocked files directly in dirpath.
+        '''
+        return [path.rpartition(os.path.sep)[2] for path in
+                self._dir_files.get(dirpath.rstrip(os.path.sep), ())]
+
+    def paths_under(self, dirpath):
+        '''
+        Returns the paths of the mocked files anywhere below dirpath.
+        '''
+        paths = []
+        dirpaths = [dirpath.rstrip(os.path.sep)]
+        while dirpaths:
+            dirpath = dirpaths.pop()
+            paths.extend(self._dir_files.get(dirpath, ()))
+            dirpaths.extend(self._subdirs.get(dirpath, ()))
+        return paths
+
+
 class MockFilesystem(object):
     _instance = None
 
     def __init__(self):
-        self._files = dict()
+        self._files = _FileIndex()
         self.active = False
         self.old_exists = None
         self.old_open = None
@@ -201,6 +468,31 @@ class MockFilesystem(object):
         self.old_fcntl_flock = None
         self.real_files_mock_removed = set()
         self.real_dirs_hidden = set()
+        self._hidden_paths_cache = {}
+        # Whether real paths exist, as last looked up with old_exists(). The
+        # mocked filesystem is not expected to change the real one, but the
+        # answers are forgotten whenever the mocked filesystem is changed.
+        self._real_paths_cache = {}
+        self.real_path_hits = 0
+        self.real_path_misses = 0
+        # Real directories added with add_directory() whose files are only
+        # mocked once they are looked up, as (link_dir, real_dir) pairs
+        self._overlays = []
+        self._overlay_trees_loaded = set()
+        self._overlay_paths_looked_up = set()
+        self._overlay_paths_removed = set()
+        # Told about the real files read into the mocked filesystem, if set
+        self.dependency_tracker = None
+
+    @property
+    def _files(self):
+        return self._file_index
+
+    @_files.setter
+    def _files(self, files):
+        if not isinstance(files, _FileIndex):
+            files = _FileIndex(files)
+        self._file_index = files
 
     def mock_flock(self, fd, op):
         pass
@@ -212,6 +504,7 @@ class MockFilesystem(object):
     def mock_open(self, filename, mode="r", buffering=None):
         if filename in ALLOWED_FILES:
             return self.old_open(filename, mode, buffering or 0)
+        self._load_overlays(filename)
         if filename not in self._files and "r" in mode and self.old_open:
             if self.is_real_path_hidden(filename):
                 raise IOError('No such file or directory: {0}'.
@@ -220,6 +513,7 @@ class MockFilesystem(object):
         elif "w" in mode:
             self._validate_mock_open(filename, mode, buffering)
             self._files[filename] = MockFile()
+            self._forget_real_paths()
         if filename in self._files \
                 and isinstance(self._files[filename], MockFile):
             self._files[filename]._name = filename
@@ -243,9 +537,30 @@ class MockFilesystem(object):
 
     def hide_real_directory(self, dirpath):
         self.real_dirs_hidden.add(self._add_slash(dirpath))
+        self._hidden_paths_cache.clear()
+        self._forget_real_paths()
 
     def is_real_path_hidden(self, path):
-        return any([path.startswith(d) for d in self.real_dirs_hidden])
+        '''
+        Returns whether path is below one of the hidden real directories.
+        Only the path's own directories, up to each '/' in it, are looked up,
+        however many directories are hidden.
+        '''
+        if not self.real_dirs_hidden:
+            return False
+        hidden = self._hidden_paths_cache.get(path)
+        if hidden is None:
+            hidden = False
+            end = path.find('/')
+            while end != -1:
+                if path[:end + 1] in self.real_dirs_hidden:
+                    hidden = True
+                    break
+                end = path.find('/', end + 1)
+            if len(self._hidden_paths_cache) >= HIDDEN_PATHS_CACHE_SIZE:
+                self._hidden_paths_cache.clear()
+            self._hidden_paths_cache[path] = hidden
+        return hidden
 
     def mock_fsync(self, fileno):
         try:
@@ -275,52 +590,56 @@ class MockFilesystem(object):
     def mock_exists(self, path):
         if path in self.real_files_mock_removed:
             return False
-        return path in self._paths() or (self.old_exists and
-            self.old_exists(path) and not self.is_real_path_hidden(path))
+        self._load_overlays(path)
+        return self._files.has_path(path) or (self.old_exists and
+            self._real_exists(path) and not self.is_real_path_hidden(path))
 
     def mock_isdir(self, path):
         while path.endswith(os.path.sep):
             path = path[:-len(os.path.sep)]
         if not path:
             path = os.path.sep
-        return path in (self._paths() - set(self._files.keys())) or (
+        self._load_overlays(path)
+        return self._files.has_dir(path) or (
             self.old_exists and
-            self.old_exists(path) and not
+            self._real_exists(path) and not
             self.is_real_path_hidden(path))
 
     def mock_isfile(self, path):
         if path.endswith(os.path.sep):
             return False
-        return path in (self._files.keys()) or (
+        self._load_overlays(path)
+        return path in self._files or (
             self.old_exists and
-            self.old_exists(path) and not
+            self._real_exists(path) and not
             self.is_real_path_hidden(path))
 
+    def _real_exists(self, path):
+        exists = self._real_paths_cache.get(path)
+        if exists is None:
+            self.real_path_misses += 1
+            exists = self._real_paths_cache[path] = self.old_exists(path)
+        else:
+            self.real_path_hits += 1
+        return exists
+
+    def _forget_real_paths(self):
+        self._real_paths_cache.clear()
+
     def mock_islink(self, path):
         return False
 
     def _paths(self):
-        mocked_paths = set()
-
-        def add_upstream_path(dirs, rightmost_dir):
-            if not rightmost_dir:
-                return ['']
-
-            dirs.extend([rightmost_dir])
-            mocked_paths.add(os.path.sep.join(dirs))
-            return dirs
-
-        for mocked_file in self._files.keys():
-            path_tokens = mocked_file.split(os.path.sep)
-            reduce(add_upstream_path, path_tokens, [])
-
-        return mocked_paths
+        return set(self._files._path_refs)
 
     def mock_remove(self, path):
+        self._load_overlays(path)
+        self._forget_real_paths()
         if path in self._files:
             if type(self._files[path]) == file:
                 self._files[path].close()
             del self._files[path]
+            self._overlay_paths_removed.add(path)
         elif path in self.real_files_mock_removed or \
                      self.is_real_path_hidden(path):
             raise OSError("No such file or directory: '{0}'".format(path))
@@ -330,66 +649,65 @@ class MockFilesystem(object):
             raise OSError("No such file or directory: '{0}'".format(path))
 
     def mock_makedirs(self, path, mode=0777):
-        pass
+        self._forget_real_paths()
 
     def mock_rename(self, from_file, to_file):
         if from_file in self.real_files_mock_removed:
             raise OSError('No such file or directory: {0}'.format(from_file))
+        self._load_overlays(from_file)
+        self._forget_real_paths()
         if from_file not in self._files:
             if self.is_real_path_hidden(from_file):
                 raise OSError('No such file or directory: {0}'.
                               format(from_file))
             try:
                 self._files[to_file] = MockFile(
-                        self.old_open(from_file).read())
+                        self._read_real_file(from_file))
             except:
                 raise OSError
         else:
-            newfile = MockFile()
-            newfile.lines = list(self._files[from_file].lines)
-            self._files[to_file] = newfile
-            del self._files[from_file]
+            self._files[to_file] = self._files.pop(from_file)
+            self._overlay_paths_removed.add(from_file)
+
+    def files_under(self, dirpath):
+        '''
+        Returns the paths of the mocked files anywhere below dirpath.
+        '''
+        self._load_overlays(dirpath)
+        return self._files.paths_under(dirpath)
 
     def mock_copy_tree(self, from_dir, to_dir):
-        old_files = copy.deepcopy(self._files)
         if not from_dir.endswith('/'):
             from_dir += '/'
         if not to_dir.endswith('/'):
             to_dir += '/'
-        for path in old_files:
-            if path.startswith(from_dir):
-                copy_path = path.replace(from_dir, to_dir)
-                self.mock_copy(path, copy_path)
+        for path in self.files_under(from_dir):
+            copy_path = to_dir + path[len(from_dir):]
+            self.mock_copy(path, copy_path)
 
     def mock_remove_tree(self, remove_dir):
-        old_files = copy.deepcopy(self._files)
-        if not remove_dir.endswith('/'):
-            remove_dir += '/'
-        for path in old_files:
-            if path.startswith(remove_dir):
-                self.mock_remove(path)
+        for path in self.files_under(remove_dir):
+            self.mock_remove(path)
 
     def mock_copy(self, from_file, to_file):
         if from_file in self.real_files_mock_removed:
             raise IOError('No such file or directory: {0}'.format(from_file))
+        self._load_overlays(from_file)
+        self._forget_real_paths()
         if from_file not in self._files:
             if self.is_real_path_hidden(from_file):
                 raise IOError('No such file or directory: {0}'.
                               format(from_file))
-            self._files[to_file] = MockFile(self.old_open(from_file).read())
+            self._files[to_file] = MockFile(self._read_real_file(from_file))
             self._files[to_file]._name = to_file
         else:
-            newfile = MockFile()
+            newfile = self._files[from_file].copy()
             newfile._name = to_file
-            newfile.lines = list(self._files[from_file].lines)
             self._files[to_file] = newfile
 
     def mock_listdir(self, dirpath):
-        files = []
-        for filepath in self._files:
-            filename = filepath[len(dirpath):].lstrip('/')
-            if filepath.startswith(dirpath) and '/' not in filename:
-                files.append(filename)
+        self._load_overlays(dirpath)
+        files = list(self._files.filenames(dirpath))
 
         if not self.is_real_path_hidden(self._add_slash(dirpath)):
             try:
@@ -405,28 +723,174 @@ class MockFilesystem(object):
         return files
 
     def add_directory(self, link_dir, relative_dir, overlay=True):
+        '''
+        Mocks the files found under relative_dir at the same paths under
+        link_dir. Nothing is read from relative_dir yet: its files are
+        listed when a path they could be at is looked up, and read when they
+        are first opened.
+        '''
         if not overlay:
             self.hide_real_directory(link_dir)
         relative_dir = os.path.abspath(relative_dir)
-        for root, dirs, files in os.walk(relative_dir):
-            root = root[len(relative_dir):].lstrip('/')
-            for filename in files:
-                contents = self._read_real_file(os.path.join(relative_dir,
-                    root, filename))
-                self._files[os.path.join(link_dir, root, filename)] = \
-                    MockFile(contents)
+        link_dir = link_dir.rstrip(os.path.sep)
+
+        # The directory's files replace those already mocked at their paths,
+        # including any that were removed
+        for path in self._files.paths_under(link_dir):
+            if self._is_real_file(relative_dir + path[len(link_dir):]):
+                del self._files[path]
+        self._overlay_paths_removed = set(
+            path for path in self._overlay_paths_removed if not (
+                path.startswith(link_dir + os.path.sep) and
+                self._is_real_file(relative_dir + path[len(link_dir):])))
+        # and so the trees already listed below link_dir are listed again
+        self._overlay_trees_loaded = set(
+            tree for tree in self._overlay_trees_loaded if not (
+                tree[2] == link_dir or
+                tree[2].startswith(link_dir + os.path.sep)))
+
+        self._overlays.append((link_dir, relative_dir))
+        self._overlay_paths_looked_up.clear()
+        self._forget_real_paths()
+
+    def _is_real_file(self, path):
+        real_stat = _real_stat(path)
+        return real_stat is not None and stat.S_ISREG(real_stat.st_mode)
+
+    def _load_overlays(self, path):
+        '''
+        Mocks the files from directories added with add_directory() that are
+        at path, or anywhere below it.
+        '''
+        if not self._overlays or not isinstance(path, basestring) or \
+                path in self._overlay_paths_looked_up:
+            return
+        self._overlay_paths_looked_up.add(path)
+        path = path.rstrip(os.path.sep)
+
+        # The most recently added directories take precedence
+        for link_dir, real_dir in reversed(self._overlays):
+            if path == link_dir or path.startswith(link_dir + os.path.sep):
+                real_path = real_dir + path[len(link_dir):]
+                real_stat = _real_stat(real_path)
+                if real_stat is None:
+                    continue
+                if stat.S_ISDIR(real_stat.st_mode):
+                    self._load_overlay_tree(link_dir, real_dir, path)
+                elif stat.S_ISREG(real_stat.st_mode):
+                    self._add_overlay_file(path, real_path)
+            elif not path or link_dir.startswith(path + os.path.sep):
+                self._load_overlay_tree(link_dir, real_dir, link_dir)
+
+    def _load_overlay_tree(self, link_dir, real_dir, link_path):
+        for upstream_path in _upstream_paths(link_path):
+            if (link_dir, real_dir, upstream_path) in \
+                    self._overlay_trees_loaded:
+                return
+        self._overlay_trees_loaded.add((link_dir, real_dir, link_path))
+
+        listdir = self.old_listdir or os.listdir
+        dirpaths = [link_path]
+        while dirpaths:
+            dirpath = dirpaths.pop()
+            real_dirpath = real_dir + dirpath[len(link_dir):]
+            try:
+                filenames = listdir(real_dirpath)
+            except OSError:
+                continue
+            for filename in filenames:
+                real_path = os.path.join(real_dirpath, filename)
+                try:
+                    real_stat = os.lstat(real_path)
+                    if stat.S_ISLNK(real_stat.st_mode):
+                        # Like os.walk(), follow links to files but not
+                        # links to directories
+                        real_stat = os.stat(real_path)
+                        if stat.S_ISDIR(real_stat.st_mode):
+                            continue
+                except OSError:
+                    continue
+                if stat.S_ISDIR(real_stat.st_mode):
+                    dirpaths.append(os.path.join(dirpath, filename))
+                elif stat.S_ISREG(real_stat.st_mode):
+                    self._add_overlay_file(os.path.join(dirpath, filename),
+                                           real_path)
+
+    def _add_overlay_file(self, path, real_path):
+        if path not in self._files and \
+                path not in self._overlay_paths_removed:
+            self._files[path] = MockFile.lazy(
+                lambda: self._read_real_file(real_path), path)
 
     def _read_real_file(self, filepath):
+        if self.dependency_tracker is not None:
+            self.dependency_tracker.add_path(filepath)
+        real_stat = _real_stat(filepath)
+        if real_stat is not None:
+            version = (real_stat.st_mtime, real_stat.st_size)
+        else:
+            version = None
+        cached = _real_file_contents.get(filepath)
+        if cached is not None and version is not None and \
+                cached[0] == version:
+            return cached[1]
+
         if self.old_open:
-            return self.old_open(filepath).read()
+            contents = self.old_open(filepath).read()
         else:
-            return open(filepath).read()
+            contents = open(filepath).read()
+        contents = _intern_contents(contents)
+        if version is not None:
+            _real_file_contents[filepath] = (version, contents)
+        return contents
+
+    def checkpoint(self):
+        '''
+        Returns the state of the mocked filesystem, in a form that can be
+        pickled, or None if it holds real files.
+        '''
+        files = {}
+        for path, mock_file in self._files.iteritems():
+            if not isinstance(mock_file, MockFile):
+                return None
+            if mock_file._loader is not None:
+                # Files from added directories that have not been read yet
+                # are mocked again when they are looked up, unless they
+                # have been copied or moved away from their overlay path
+                if mock_file._overlay_path == path:
+                    continue
+                mock_file.dump()
+            files[path] = mock_file.copy()
+        return {
+            'files': files,
+            'real_files_mock_removed': set(self.real_files_mock_removed),
+            'real_dirs_hidden': set(self.real_dirs_hidden),
+            'overlays': list(self._overlays),
+            'overlay_paths_removed': set(self._overlay_paths_removed),
+        }
+
+    def restore_checkpoint(self, state):
+        '''
+        Replaces the state of the mocked filesystem with one returned by
+        checkpoint().
+        '''
+        self._files = dict((path, mock_file.copy())
+                           for path, mock_file in state['files'].iteritems())
+        self.real_files_mock_removed = set(state['real_files_mock_removed'])
+        self.real_dirs_hidden = set(state['real_dirs_hidden'])
+        self._hidden_paths_cache.clear()
+        self._overlays = list(state['overlays'])
+        self._overlay_trees_loaded = set()
+        self._overlay_paths_looked_up = set()
+        self._overlay_paths_removed = set(state['overlay_paths_removed'])
+        self._forget_real_paths()
 
     def add_file(self, filepath, contents):
         if type(contents) == file:
             self._files[filepath] = contents
         else:
             self._files[filepath] = MockFile(contents)
+        self._forget_real_paths()
 
     def hookup(self):
         if not self.active:
@@ -502,7 +966,13 @@ def create(root_path):
         raise Exception("Cannot create mockfilesystem, already exists, "
             "release the old one first")
     MockFilesystem._instance = MockFilesystem()
-    MockFilesystem._instance._files = default_files.create(root_path, MockFile)
+    if root_path not in _baseline_files:
+        _baseline_files[root_path] = _create_baseline_files(root_path)
+    # The baseline files are copied rather than shared, but their contents
+    # are shared until they are written to
+    MockFilesystem._instance._files = dict(
+        (path, mock_file.copy())
+        for path, mock_file in _baseline_files[root_path].iteritems())
     #MockFilesystem._instance.add_directory("/etc", "/etc")
     MockFilesystem._instance.add_directory(
         '/opt/ericsson/nms/litp/etc/plugins', "%s/etc/plugins" % root_path)
@@ -515,6 +985,16 @@ def create(root_path):
         "%s/share" % root_path)
     MockFilesystem._instance.add_directory(
         '/opt/ericsson/nms/litp/bin/samples', "%s/bin/samples" % root_path)
+    return MockFilesystem._instance
+
+
+def _create_baseline_files(root_path):
+    '''
+    Creates the files every mock filesystem starts with, other than those in
+    the directories added when it is created. This happens once per root path
+    in each process.
+    '''
+    MockFilesystem._instance._files = default_files.create(root_path, MockFile)
     MockFilesystem._instance.add_file('/etc/litp_logging.conf',
                                       _logging_content())
 
@@ -530,7 +1010,8 @@ def create(root_path):
         '/var/www/html/ms/path/to/yum5/repodata/repomd.xml', 'data')
     MockFilesystem._instance.add_file(
         '/opt/ericsson/nms/litp/etc/puppet/litp_config_version', '0')
-    return MockFilesystem._instance
+    return dict((path, mock_file.copy())
+                for path, mock_file in MockFilesystem._instance._files.items())
 
 
 def destroy():
@@ -3,6 +3,7 @@ import functools
 import cherrypy
 from ..mocking import core_patch, _resolve_qual_name
 from litpats.mocking.mock_puppetdb_api import MockPuppetDbApi
+from litpats.schema_cache import CachingEtree
 
 
 @core_patch('litp.core.puppetdb_api.urlopen')
@@ -207,3 +208,13 @@ def _decorate_deconfigure_worker(core_deconfigure_worker):
         scope.data_manager = backup["scope_data_manager"]
 
     return deconfigure_worker_wrapper
+
+
+@core_patch('litp.xml.xml_loader.etree')
+def _decorate_xml_loader_etree(core_etree):
+    '''
+    Ensures the XSDs that XmlLoader validates models against are compiled
+    once per process, rather than every time the XSDs are regenerated.
+    Only XmlLoader's own reference to lxml.etree is replaced.
+    '''
+    return CachingEtree(core_etree)
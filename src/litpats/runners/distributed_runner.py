@@ -0,0 +1,402 @@
+import errno
+import json
+import os
+import select
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import traceback
+from collections import deque
+
+from litpats.runners.forking_runner import OutputSink
+
+
+READ_SIZE = 64 * 1024
+SPOOL_SIZE = 1024 * 1024
+# How many times a task is handed to another worker after the worker running
+# it has gone away, before the task is reported as failed
+MAX_REQUEUES = 2
+
+
+def parse_address(address):
+    '''
+    Parses a HOST:PORT string into a (host, port) tuple.
+    '''
+    host, _, port = address.rpartition(':')
+    try:
+        return (host or 'localhost', int(port))
+    except ValueError:
+        raise ValueError("Invalid address %r, expected HOST:PORT" % address)
+
+
+def _send(sock, message):
+    sock.sendall(json.dumps(message) + '\n')
+
+
+def _encode_output(data):
+    # AT output is not guaranteed to be valid UTF-8, but every byte string
+    # survives a round trip through latin-1 unchanged
+    return data.decode('latin-1')
+
+
+def _decode_output(data):
+    return data.encode('latin-1')
+
+
+class _WorkerConnection(object):
+    '''
+    The coordinator's side of a connection to a worker.
+    '''
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.task_id = None
+        self.wants_task = False
+        self._buf = ''
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self):
+        '''
+        Returns the messages received from the worker, or None if the worker
+        has gone away.
+        '''
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except socket.error as ex:
+            if ex.errno == errno.EINTR:
+                return []
+            data = ''
+        if not data:
+            return None
+        lines = (self._buf + data).split('\n')
+        self._buf = lines.pop()
+        return [json.loads(line) for line in lines if line]
+
+    def close(self):
+        self.sock.close()
+
+
+class _RemoteTask(object):
+    '''
+    The coordinator's record of a named task: its output, held back until
+    its turn comes unless it is being streamed, and eventually its result.
+    '''
+
+    def __init__(self, name, expected_duration):
+        self.name = name
+        self.expected_duration = expected_duration
+        self.requeues = 0
+        self.done = False
+        self.result = None
+        self.streaming = False
+        self._buffers = {}
+        self._sinks = {}
+        self._reset_buffers()
+
+    def _reset_buffers(self):
+        for buf in self._buffers.values():
+            buf.close()
+        self._buffers = {
+            'stdout': tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE),
+            'stderr': tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE),
+        }
+
+    def write(self, stream, data):
+        if self.streaming:
+            self._sinks[stream].write(data)
+        else:
+            self._buffers[stream].write(data)
+
+    def stream_output(self, prefix=''):
+        '''
+        Writes the task's output to this process' stdout and stderr as it
+        arrives, rather than when the task is done.
+        '''
+        self._sinks = {
+            'stdout': OutputSink(sys.stdout, prefix),
+            'stderr': OutputSink(sys.stderr, prefix),
+        }
+        self._flush_buffers(self._sinks)
+        self.streaming = True
+
+    def restart(self, message):
+        '''
+        Drops the output held back for a task whose worker has gone away, and
+        explains why the task's output starts again.
+        '''
+        self._reset_buffers()
+        self.write('stderr', message + '\n')
+
+    def finish(self, result):
+        self.done = True
+        self.result = result
+
+    def dump_output(self):
+        self._flush_buffers({'stdout': sys.stdout, 'stderr': sys.stderr})
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for buf in self._buffers.values():
+            buf.close()
+        for sink in self._sinks.values():
+            sink.close()
+
+    def _flush_buffers(self, outs):
+        for stream in ('stdout', 'stderr'):
+            buf = self._buffers[stream]
+            buf.seek(0)
+            shutil.copyfileobj(buf, outs[stream], READ_SIZE)
+            buf.seek(0)
+            buf.truncate()
+
+
+class DistributedRunner(object):
+    '''
+    Serves tasks to worker processes, on this host or any other, that connect
+    to ``address`` and run them with ``run_worker()``.
+
+    Tasks are identified by name only: workers decide for themselves how to
+    run a named task. Each worker pulls one task at a time, longest expected
+    duration first, streams back its output as it is produced and then sends
+    its result and duration. If a worker goes away before sending back a
+    result, its task is handed to another worker, up to ``MAX_REQUEUES``
+    times, after which the task fails.
+
+    Output and results are reported in the order in which the tasks were
+    added, as in ForkingRunner: the output of the earliest added task that
+    is still running is written out as it arrives, and with ``live_output``
+    the output of every task is, with each line prefixed with its name.
+    '''
+
+    def __init__(self, address, live_output=False):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(address)
+        self._server.listen(socket.SOMAXCONN)
+        self.address = self._server.getsockname()
+        self._live_output = live_output
+        self._tasks = []
+        self.durations = {}
+
+    def add_task(self, func, *args, **kwargs):
+        raise TypeError("Tasks run by remote workers must be named")
+
+    def add_timed_task(self, name, expected_duration, func, *args, **kwargs):
+        '''
+        Adds the named task. The callable and its arguments are not used,
+        since workers run the named task themselves.
+        '''
+        self._tasks.append(_RemoteTask(name, expected_duration))
+
+    def run_tasks(self):
+        results = []
+        waiting = deque(sorted(
+            range(len(self._tasks)),
+            key=lambda task_id: self._tasks[task_id].expected_duration,
+            reverse=True))
+        connections = []
+        try:
+            while len(results) < len(self._tasks):
+                try:
+                    readable, _, _ = select.select(
+                        [self._server] + connections, [], [])
+                except select.error as ex:
+                    if ex.args[0] != errno.EINTR:
+                        raise
+                    continue
+
+                for conn in readable:
+                    if conn is self._server:
+                        sock, _ = self._server.accept()
+                        connections.append(_WorkerConnection(sock))
+                        continue
+                    messages = conn.receive()
+                    if messages is None:
+                        if conn.task_id is not None:
+                            self._requeue(conn.task_id, waiting)
+                        connections.remove(conn)
+                        conn.close()
+                        continue
+                    for message in messages:
+                        self._handle_message(conn, message)
+
+                for conn in connections:
+                    if conn.wants_task and waiting:
+                        self._assign_task(conn, waiting.popleft())
+
+                # Output the results from any completed tasks in the order in
+                # which they were added, and stream the output of the
+                # earliest task still running
+                while len(results) < len(self._tasks):
+                    task = self._tasks[len(results)]
+                    if not task.done:
+                        if not task.streaming and not self._live_output:
+                            task.stream_output()
+                        break
+                    results.append(task.result)
+                    task.dump_output()
+        finally:
+            for conn in connections:
+                try:
+                    _send(conn.sock, {'op': 'done'})
+                except socket.error:
+                    pass
+                conn.close()
+            self._server.close()
+
+        return results
+
+    def _handle_message(self, conn, message):
+        if message['op'] == 'next':
+            conn.wants_task = True
+        elif message['op'] == 'output':
+            self._tasks[message['id']].write(message['stream'],
+                                             _decode_output(message['data']))
+        elif message['op'] == 'result':
+            task = self._tasks[message['id']]
+            conn.task_id = None
+            task.finish(message['result'])
+            self.durations[task.name] = message['duration']
+        else:
+            raise Exception("Unexpected message from worker: %r" % message)
+
+    def _requeue(self, task_id, waiting):
+        task = self._tasks[task_id]
+        if task.requeues >= MAX_REQUEUES:
+            task.write('stderr', "The workers running %s went away %d times, "
+                       "giving up on it\n" % (task.name, task.requeues + 1))
+            task.finish(False)
+            return
+        # Hand the worker's unfinished task to another worker
+        task.requeues += 1
+        task.restart("The worker running %s went away, running it again" %
+                     task.name)
+        waiting.appendleft(task_id)
+
+    def _assign_task(self, conn, task_id):
+        conn.wants_task = False
+        conn.task_id = task_id
+        task = self._tasks[task_id]
+        if self._live_output and not task.streaming:
+            task.stream_output("[%s] " % task.name)
+        _send(conn.sock, {'op': 'run', 'id': task_id, 'name': task.name})
+
+
+def _connect(address, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return socket.create_connection(address)
+        except socket.error as ex:
+            if ex.errno not in (errno.ECONNREFUSED, errno.EINTR) or \
+                    time.time() > deadline:
+                raise
+            # The coordinator may not be listening yet
+            time.sleep(0.1)
+
+
+def _run_task(func, name, send_output):
+    '''
+    Runs func(name) in a child process, passing its output to
+    send_output(stream, data) as it is read, and returns its result and
+    duration.
+    '''
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    start_time = time.time()
+
+    pid = os.fork()
+    if pid == 0:
+        #child
+        result = False
+        try:
+            os.close(out_r)
+            os.close(err_r)
+            os.dup2(out_w, sys.stdout.fileno())
+            os.dup2(err_w, sys.stderr.fileno())
+            result = func(name)
+        except:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0 if result else 1)
+
+    #parent
+    os.close(out_w)
+    os.close(err_w)
+    streams = {out_r: 'stdout', err_r: 'stderr'}
+    try:
+        while streams:
+            try:
+                readable, _, _ = select.select(list(streams), [], [])
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in readable:
+                data = os.read(fd, READ_SIZE)
+                if data:
+                    send_output(streams[fd], data)
+                else:
+                    del streams[fd]
+    finally:
+        os.close(out_r)
+        os.close(err_r)
+
+    while True:
+        try:
+            _, status = os.waitpid(pid, 0)
+            break
+        except OSError as ex:
+            if ex.errno != errno.EINTR:
+                raise
+    return status == 0, time.time() - start_time
+
+
+def run_worker(address, func, initializer=None, initargs=(),
+               connect_timeout=30.0):
+    '''
+    Connects to the DistributedRunner serving tasks at ``address`` and runs
+    the named tasks it hands out, one at a time, by calling ``func(name)`` in
+    a child process. The initializer, if given, is called once before the
+    first task is requested. Returns the number of tasks run.
+    '''
+    if initializer is not None:
+        initializer(*initargs)
+
+    sock = _connect(address, connect_timeout)
+    coordinator = sock.makefile('r')
+    tasks_run = 0
+    try:
+        while True:
+            _send(sock, {'op': 'next'})
+            line = coordinator.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            if message['op'] != 'run':
+                break
+
+            # Task names are AT paths, which the rest of the runner expects
+            # to be byte strings
+            name = message['name'].encode('utf-8')
+            task_id = message['id']
+
+            def send_output(stream, data):
+                _send(sock, {'op': 'output', 'id': task_id, 'stream': stream,
+                             'data': _encode_output(data)})
+
+            result, duration = _run_task(func, name, send_output)
+            _send(sock, {'op': 'result', 'id': task_id,
+                         'result': result, 'duration': duration})
+            tasks_run += 1
+    finally:
+        coordinator.close()
+        sock.close()
+    return tasks_run
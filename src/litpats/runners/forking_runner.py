@@ -1,48 +1,111 @@
-import cStringIO
 import errno
 import fcntl
 import os
 import select
+import shutil
+import signal
 import sys
+import tempfile
+import time
+from collections import deque
+
+
+def _set_non_blocking(fd):
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+
+def _handle_sigchld(signum, frame):
+    # The signal module writes to the wakeup fd; there is nothing else to do
+    pass
+
+
+class OutputSink(object):
+    '''
+    Writes a worker's output straight to one of this process' streams, with
+    every line optionally prefixed so that interleaved output can be told
+    apart.
+    '''
+
+    def __init__(self, out, prefix=''):
+        self._out = out
+        self._prefix = prefix
+        self._partial_line = ''
+
+    def write(self, data):
+        if self._prefix:
+            lines = (self._partial_line + data).split('\n')
+            self._partial_line = lines.pop()
+            data = ''.join(self._prefix + line + '\n' for line in lines)
+        self._out.write(data)
+        self._out.flush()
+
+    def close(self):
+        if self._partial_line:
+            self._out.write(self._prefix + self._partial_line + '\n')
+            self._out.flush()
+            self._partial_line = ''
 
 
 class BufferedStream(object):
     '''
-    Wrapper class for use with select.select(), to buffer data.
+    Wrapper class for use with select.epoll(), to buffer data.
+
+    Data is buffered in memory up to SPOOL_SIZE bytes, and in a temporary file
+    beyond that. Once the stream is attached to a sink, data is written
+    straight to the sink instead.
     '''
 
+    READ_SIZE = 64 * 1024
+    SPOOL_SIZE = 1024 * 1024
+
     def __init__(self, fd):
         self._fd = fd
         # make descriptor non-blocking
-        fl = fcntl.fcntl(self._fd, fcntl.F_GETFL)
-        fcntl.fcntl(self._fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        _set_non_blocking(self._fd)
         # allocate a buffer
-        self._buf = cStringIO.StringIO()
+        self._buf = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE)
+        self._sink = None
 
     def fileno(self):
-        """Returns file descriptor: needed for select()"""
+        """Returns file descriptor: needed for epoll()"""
         return self._fd
 
     def handle_data(self):
         '''
         Drain data from the file descriptor and append it to the
-        buffer.
+        buffer, or write it to the sink.
         '''
 
         try:
-            data = os.read(self._fd, 1024)
+            data = os.read(self._fd, self.READ_SIZE)
             while len(data):
-                self._buf.write(data)
-                data = os.read(self._fd, 1024)
+                if self._sink is None:
+                    self._buf.write(data)
+                else:
+                    self._sink.write(data)
+                data = os.read(self._fd, self.READ_SIZE)
         except OSError as ex:
             if ex.errno != errno.EAGAIN:
                 raise ex
 
-    def get_data(self):
-        """Retrieve buffered data"""
-        data = self._buf.getvalue()
+    def stream_to(self, sink):
+        """Write buffered data, and all data read from now on, to sink"""
+        self._flush_buffer(sink)
+        self._sink = sink
+
+    def write_data(self, out):
+        """Write out buffered data and release the buffer"""
+        self._flush_buffer(out)
         self._buf.close()
-        return data
+        if self._sink is not None:
+            self._sink.close()
+
+    def _flush_buffer(self, out):
+        self._buf.seek(0)
+        shutil.copyfileobj(self._buf, out, self.READ_SIZE)
+        self._buf.seek(0)
+        self._buf.truncate()
 
     def close(self):
         """Close descriptor"""
@@ -61,6 +124,11 @@ class Task(object):
         self.kwargs = kwargs
         self.worker_pid = None
         # These attributes are only to be used by the parent process!
+        self.name = None
+        self.expected_duration = 0.0
+        self.start_time = None
+        self.duration = None
+        self.streaming = False
         self.state = self.WAITING
         self.out_stream = None
         self.err_stream = None
@@ -69,6 +137,7 @@ class Task(object):
         sys.stdout.flush()
         sys.stderr.flush()
 
+        self.start_time = time.time()
         stdout_pipe_r, stdout_pipe_w = os.pipe()
         stderr_pipe_r, stderr_pipe_w = os.pipe()
 
@@ -76,6 +145,9 @@ class Task(object):
 
         if pid == 0:
             #child
+            # The parent's child supervision must not leak into the worker
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.set_wakeup_fd(-1)
             os.close(stdout_pipe_r)
             os.close(stderr_pipe_r)
             os.dup2(stdout_pipe_w, sys.stdout.fileno())
@@ -115,80 +187,224 @@ class Task(object):
         self.err_stream.handle_data()
         self.err_stream.close()
 
+    def stream_output(self, prefix=''):
+        '''
+        Writes the worker's output to this process' stdout and stderr as it
+        arrives, rather than when the task is done.
+        '''
+        self.out_stream.stream_to(OutputSink(sys.stdout, prefix))
+        self.err_stream.stream_to(OutputSink(sys.stderr, prefix))
+        self.streaming = True
+
     def dump_output(self):
         if self.state != self.DONE:
             raise Exception("Unexpected state {0}".format(self.state))
-        sys.stdout.write(self.out_stream.get_data())
+        self.out_stream.write_data(sys.stdout)
         sys.stdout.flush()
-        sys.stderr.write(self.err_stream.get_data())
+        self.err_stream.write_data(sys.stderr)
         sys.stderr.flush()
 
 
+class ChildEvents(object):
+    '''
+    Waits for output from worker processes and for their termination.
+
+    Terminations are signalled through a self-pipe: the SIGCHLD handler's
+    wakeup fd is watched with epoll alongside the workers' output streams,
+    so a worker that exits is reaped straight away whether or not it wrote
+    any output. Outside the main thread, where signal handlers cannot be
+    installed, dead workers are polled for instead.
+    '''
+
+    POLL_INTERVAL = 0.1
+
+    def __init__(self):
+        self._epoll = select.epoll()
+        self._streams = {}
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        _set_non_blocking(self._wakeup_r)
+        _set_non_blocking(self._wakeup_w)
+        self._epoll.register(self._wakeup_r, select.EPOLLIN)
+        try:
+            self._old_handler = signal.signal(signal.SIGCHLD,
+                                              _handle_sigchld)
+        except ValueError:
+            self._old_handler = None
+            self._timeout = self.POLL_INTERVAL
+        else:
+            # Let interrupted system calls other than epoll_wait() resume
+            signal.siginterrupt(signal.SIGCHLD, False)
+            self._old_wakeup_fd = signal.set_wakeup_fd(self._wakeup_w)
+            self._timeout = -1
+
+    def add_stream(self, stream):
+        self._streams[stream.fileno()] = stream
+        self._epoll.register(stream.fileno(), select.EPOLLIN)
+
+    def remove_stream(self, stream):
+        if self._streams.pop(stream.fileno(), None) is not None:
+            self._epoll.unregister(stream.fileno())
+
+    def wait(self):
+        '''
+        Blocks until output is available or a worker may have exited, buffers
+        the available output and returns whether a worker may have exited.
+        '''
+        try:
+            events = self._epoll.poll(self._timeout)
+        except (IOError, OSError) as ex:
+            if ex.errno != errno.EINTR:
+                raise
+            return True
+
+        children_exited = self._old_handler is None
+        for fd, event in events:
+            if fd == self._wakeup_r:
+                self._drain_wakeup_fd()
+                children_exited = True
+                continue
+            stream = self._streams[fd]
+            stream.handle_data()
+            if event & (select.EPOLLHUP | select.EPOLLERR):
+                # The worker closed its end of the pipe: stop watching it, or
+                # epoll would keep reporting the hang-up
+                self.remove_stream(stream)
+        return children_exited
+
+    def _drain_wakeup_fd(self):
+        try:
+            while os.read(self._wakeup_r, 1024):
+                pass
+        except OSError as ex:
+            if ex.errno != errno.EAGAIN:
+                raise
+
+    def close(self):
+        if self._old_handler is not None:
+            signal.set_wakeup_fd(self._old_wakeup_fd)
+            signal.signal(signal.SIGCHLD, self._old_handler)
+        self._epoll.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+
+
 class ForkingRunner(object):
     '''
     Runs multiple tests at a time, in child processes
+
+    If an ``initializer`` callable is given, this process acts as a zygote: the
+    initializer is called once, before the first worker is forked, and every
+    worker is then forked from the warmed-up image rather than repeating the
+    same expensive setup itself.
+
+    Tasks are started longest first, according to their expected duration,
+    but their output and results are always reported in the order in which
+    the tasks were added. The output of the earliest added task that is still
+    running is written out as it arrives; the output of the other tasks is
+    held back until their turn comes. With ``live_output``, the output of
+    every task is written out as it arrives instead, with each line prefixed
+    with the task's name.
     '''
 
-    def __init__(self, num_workers=4):
+    def __init__(self, num_workers=4, initializer=None, initargs=(),
+                 live_output=False):
         self._num_workers = num_workers
-        self._tasks = []
+        self._tasks = deque()
+        self._running = {}
+        self._initializer = initializer
+        self._initargs = initargs
+        self._live_output = live_output
+        self.durations = {}
 
     def add_task(self, func, *args, **kwargs):
         self._tasks.append(Task(func, *args, **kwargs))
 
-    def _reap_child(self, pid, status):
+    def add_timed_task(self, name, expected_duration, func, *args, **kwargs):
+        '''
+        Adds a task whose duration is recorded in ``durations`` under the
+        given name once it has run.
+        '''
+        task = Task(func, *args, **kwargs)
+        task.name = name
+        task.expected_duration = expected_duration
+        self._tasks.append(task)
+
+    def _start_task(self, t, events):
+        t.start()
+        self._running[t.worker_pid] = t
+        events.add_stream(t.out_stream)
+        events.add_stream(t.err_stream)
+        if self._live_output:
+            t.stream_output("[%s] " % (t.name or t.worker_pid))
+
+    def _stream_head_output(self):
+        head = self._tasks[0] if self._tasks else None
+        if head is not None and head.state == Task.RUNNING and \
+                not head.streaming:
+            head.stream_output()
+
+    def _reap_child(self, pid, status, events):
         #print "pid: %d status: %d" % (pid, status)
-        found = False
-        for t in self._tasks:
-            if t.state == t.RUNNING and t.worker_pid == pid:
-                found = True
-                t.close_worker_buffered_streams()
-                t.result = (status == 0)
-                t.state = t.DONE
-                t.worker_pid = None
-                break
-        if not found:
+        t = self._running.pop(pid, None)
+        if t is None:
             raise Exception('Unexpected child pid: %d' % pid)
+        events.remove_stream(t.out_stream)
+        events.remove_stream(t.err_stream)
+        t.close_worker_buffered_streams()
+        t.result = (status == 0)
+        t.duration = time.time() - t.start_time
+        if t.name is not None:
+            self.durations[t.name] = t.duration
+        t.state = t.DONE
+        t.worker_pid = None
+
+    def _reap_children(self, events):
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            while pid != 0:
+                self._reap_child(pid, status, events)
+                pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError as ex:
+            if ex.errno != errno.ECHILD:
+                raise ex
+
+    def _warm_up(self):
+        if self._initializer is not None:
+            initializer, self._initializer = self._initializer, None
+            initializer(*self._initargs)
 
     def run_tasks(self):
         results = []
-        SELECT_TIMEOUT = 10.0
-        while self._tasks:
-            running = [t for t in self._tasks if t.state == t.RUNNING]
-            waiting = [t for t in self._tasks if t.state == t.WAITING]
-
-            # Spawn new workers, up to specified number
-            while (len(running) < self._num_workers) and waiting:
-                waiting[0].start()
-                running = [t for t in self._tasks if t.state == t.RUNNING]
-                waiting = [t for t in self._tasks if t.state == t.WAITING]
-
-            if running:
-                # Read and buffer available data from child stdout/stderr
-
-                read_streams = [t.out_stream for t in running]
-                read_streams.extend([t.err_stream for t in running])
-
-                read_streams, _, _ = select.select(read_streams,
-                                             [], [], SELECT_TIMEOUT)
-                for s in read_streams:
-                    s.handle_data()
-
-            # Reap any dead children
-            try:
-                pid, status = os.waitpid(-1, os.WNOHANG)
-                while pid != 0:
-                    self._reap_child(pid, status)
-                    pid, status = os.waitpid(-1, os.WNOHANG)
-            except OSError as ex:
-                if ex.errno != errno.ECHILD:
-                    raise ex
-
-            # Output the results from any completed tasks at head of list,
-            # and remove them
-            while self._tasks and self._tasks[0].state == Task.DONE:
-                t = self._tasks.pop(0)
-                results.append(t.result)
-                t.dump_output()
+        if not self._tasks:
+            return results
+        self._warm_up()
+        # Longest processing time first. The sort is stable, so tasks with
+        # the same expected duration start in the order they were added.
+        waiting = deque(sorted(self._tasks,
+                               key=lambda t: t.expected_duration,
+                               reverse=True))
+        # The SIGCHLD handler must be in place before the first fork, so that
+        # no worker can exit unnoticed
+        events = ChildEvents()
+        try:
+            while self._tasks:
+                # Spawn new workers, up to specified number
+                while len(self._running) < self._num_workers and waiting:
+                    self._start_task(waiting.popleft(), events)
+                self._stream_head_output()
+
+                # Read and buffer available data from child stdout/stderr,
+                # and reap any dead children
+                if events.wait():
+                    self._reap_children(events)
+
+                # Output the results from any completed tasks at head of list,
+                # and remove them
+                while self._tasks and self._tasks[0].state == Task.DONE:
+                    t = self._tasks.popleft()
+                    results.append(t.result)
+                    t.dump_output()
+        finally:
+            events.close()
 
         return results
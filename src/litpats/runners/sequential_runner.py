@@ -1,14 +1,25 @@
+import time
+
+
 class SimpleRunner(object):
     """Runs tests one at a time, in the current process"""
 
     def __init__(self):
         self._results = []
         self._tasks = []
+        self.durations = {}
 
     def add_task(self, func, *args, **kwargs):
-        self._tasks.append((func, args, kwargs))
+        self._tasks.append((None, func, args, kwargs))
+
+    def add_timed_task(self, name, expected_duration, func, *args, **kwargs):
+        # Tasks run one at a time, so their order makes no difference here
+        self._tasks.append((name, func, args, kwargs))
 
     def run_tasks(self):
-        for (func, args, kwargs) in self._tasks:
+        for (name, func, args, kwargs) in self._tasks:
+            start_time = time.time()
             self._results.append(func(*args, **kwargs))
+            if name is not None:
+                self.durations[name] = time.time() - start_time
         return self._results
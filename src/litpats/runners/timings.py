@@ -0,0 +1,66 @@
+import heapq
+import json
+import os
+
+
+class TimingDatabase(object):
+    '''
+    Keeps the duration, in seconds, that each task took the last time it was
+    run, so that the longest tasks can be started first on the next run.
+
+    The durations are stored as a JSON document in a local file.
+    '''
+
+    def __init__(self, path, durations=None):
+        self.path = path
+        self.durations = durations or {}
+        self._mean_duration = self._mean(self.durations)
+
+    @staticmethod
+    def _mean(durations):
+        if durations:
+            return sum(durations.values()) / len(durations)
+        return 0.0
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as timings_file:
+                durations = json.load(timings_file)
+        except IOError:
+            durations = {}
+        except ValueError:
+            # A corrupt timing database only costs us the ordering
+            durations = {}
+        return cls(path, durations)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as timings_file:
+            json.dump(self.durations, timings_file, indent=1, sort_keys=True)
+        os.rename(tmp_path, self.path)
+
+    def expected_duration(self, name):
+        '''
+        Returns the recorded duration for the named task. Tasks that have not
+        been recorded yet are expected to take the mean recorded duration.
+        '''
+        if name in self.durations:
+            return self.durations[name]
+        return self._mean_duration
+
+    def update(self, durations):
+        self.durations.update(durations)
+        self._mean_duration = self._mean(self.durations)
+
+
+def expected_makespan(durations, num_workers):
+    '''
+    Returns the time it takes to run tasks with the given durations on
+    num_workers workers, starting the longest tasks first.
+    '''
+    finish_times = [0.0] * max(num_workers, 1)
+    for duration in sorted(durations, reverse=True):
+        earliest = heapq.heappop(finish_times)
+        heapq.heappush(finish_times, earliest + duration)
+    return max(finish_times)
@@ -0,0 +1,170 @@
+import errno
+import functools
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+
+
+# Schemas compiled from XSD files, by a hash of the XSDs they were compiled
+# from, shared by every XML loader in the process
+_compiled_schemas = {}
+# Hashes of XSD files, by their directory, their name and the names, sizes and
+# modification times of the XSDs in that directory
+_xsd_digests = {}
+
+
+def extensions_digest(extension_paths):
+    '''
+    Returns a hash of the extension directories the XSDs are generated from:
+    their paths, in order, and the names and contents of the files in them.
+    '''
+    digest = hashlib.sha1()
+    for path in extension_paths:
+        path = os.path.abspath(path)
+        digest.update(path + '\0')
+        try:
+            filenames = sorted(os.listdir(path))
+        except OSError:
+            filenames = []
+        for filename in filenames:
+            file_path = os.path.join(path, filename)
+            if not os.path.isfile(file_path):
+                continue
+            # The builtin open() may be mocked while XSDs are being generated
+            with io.open(file_path, 'rb') as conf_file:
+                contents = conf_file.read()
+            digest.update('%s\0%d\0' % (filename, len(contents)))
+            digest.update(contents)
+    return digest.hexdigest()
+
+
+class XsdCache(object):
+    '''
+    Keeps the XSDs generated for each distinct set of extensions in a
+    directory named after a hash of that set, so that they are generated
+    once and then shared by every AT, and every runner process, using the
+    same cache directory.
+
+    The XSDs are generated in a temporary directory that is renamed into
+    place once they are complete, so that concurrent processes never see a
+    partly written schema.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._schema_paths = {}
+
+    def schema_path(self, extension_paths, write_schema):
+        '''
+        Returns the directory holding the XSDs for the given extensions,
+        calling write_schema(path) to generate them into path first if they
+        are not cached yet.
+        '''
+        # The extensions are not expected to change while ATs are running
+        key = tuple(extension_paths)
+        if key not in self._schema_paths:
+            self._schema_paths[key] = self._schema_path(
+                extensions_digest(extension_paths), write_schema)
+        return self._schema_paths[key]
+
+    def _schema_path(self, digest, write_schema):
+        cached_path = os.path.join(self.directory, digest)
+        if not os.path.isdir(cached_path):
+            tmp_path = tempfile.mkdtemp(prefix=digest + '.',
+                                        dir=self.directory)
+            try:
+                tmp_schema_path = os.path.join(tmp_path, "share", "xsd")
+                os.makedirs(tmp_schema_path)
+                write_schema(tmp_schema_path)
+                try:
+                    os.rename(tmp_path, cached_path)
+                except OSError as ex:
+                    # Another process may have generated the same XSDs first
+                    if ex.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                        raise
+            finally:
+                if os.path.isdir(tmp_path):
+                    shutil.rmtree(tmp_path)
+        return os.path.join(cached_path, "share", "xsd")
+
+
+def xsd_digest(xsd_file):
+    '''
+    Returns a hash of the XSD file and of the other XSDs next to it, which it
+    may include or import.
+    '''
+    xsd_dir = os.path.dirname(os.path.abspath(xsd_file))
+    filenames = set(name for name in os.listdir(xsd_dir)
+                    if name.endswith('.xsd'))
+    filenames.add(os.path.basename(xsd_file))
+    filenames = sorted(filenames)
+    # The XSDs are only read again once one of them has been rewritten
+    stats = []
+    for filename in filenames:
+        stat = os.stat(os.path.join(xsd_dir, filename))
+        stats.append((filename, stat.st_mtime, stat.st_size))
+    key = (xsd_dir, os.path.basename(xsd_file), tuple(stats))
+    if key not in _xsd_digests:
+        _xsd_digests[key] = _read_xsd_digest(xsd_file, xsd_dir, filenames)
+    return _xsd_digests[key]
+
+
+def _read_xsd_digest(xsd_file, xsd_dir, filenames):
+    digest = hashlib.sha1(os.path.basename(xsd_file) + '\0')
+    for filename in filenames:
+        # The builtin open() may be mocked while XML is being loaded
+        with io.open(os.path.join(xsd_dir, filename), 'rb') as xsd:
+            contents = xsd.read()
+        digest.update('%s\0%d\0' % (filename, len(contents)))
+        digest.update(contents)
+    return digest.hexdigest()
+
+
+def _xsd_file(etree, file):
+    if file is not None:
+        return file
+    if hasattr(etree, 'getroottree'):
+        etree = etree.getroottree()
+    docinfo = getattr(etree, 'docinfo', None)
+    return getattr(docinfo, 'URL', None)
+
+
+def caching_xml_schema(xml_schema):
+    '''
+    Wraps lxml's XMLSchema so that the schemas read from XSD files are only
+    compiled once per process for any given XSD contents. Schemas built from
+    anything else are compiled every time, as before.
+    '''
+    # XMLSchema is a class, whose attributes the wrapper should not copy
+    @functools.wraps(xml_schema, updated=())
+    def cached_xml_schema(etree=None, file=None, **kwargs):
+        xsd_file = _xsd_file(etree, file)
+        if kwargs or not isinstance(xsd_file, basestring):
+            return xml_schema(etree, file=file, **kwargs)
+        try:
+            key = xsd_digest(xsd_file)
+        except (IOError, OSError):
+            return xml_schema(etree, file=file)
+        if key not in _compiled_schemas:
+            _compiled_schemas[key] = xml_schema(etree, file=file)
+        return _compiled_schemas[key]
+
+    return cached_xml_schema
+
+
+class CachingEtree(object):
+    '''
+    Stands in for lxml.etree in a single module, building its schemas with
+    caching_xml_schema() and leaving everything else to lxml, so that lxml
+    itself, and any isinstance() check against its XMLSchema class, is left
+    alone.
+    '''
+
+    def __init__(self, etree):
+        self._etree = etree
+        self.XMLSchema = caching_xml_schema(etree.XMLSchema)
+
+    def __getattr__(self, name):
+        return getattr(self._etree, name)
@@ -3,13 +3,21 @@ import unittest
 import logging
 import StringIO
 
+import cherrypy
+
 from mock import patch
 from mock import Mock
 from mock import MagicMock
 from mock import call
 
-from litpats.atcli import ATCli, MockFilesystemContext
+from litpats.atcli import ATCli, MockFilesystemContext, PlanIndex
+from litpats.atcli import LandscapeSnapshot
+from litpats.atcli import ScriptCheckpoint
+from litpats.atcompiler import ScriptBatch
+from litpats.atcompiler import batch_assertions
+from litpats.atcompiler import compile_script
 from litpats import mockfilesystem
+from litpats.mock_http_connection import MockHTTPConnection
 from litp.core.model_manager import ModelManager
 from litp.core.nextgen.execution_manager import ExecutionManager
 from litp.core.nextgen.puppet_manager import PuppetManager
@@ -225,6 +233,34 @@ class TestATCli(unittest.TestCase):
         ret_kwargs, ret_task_kwargs = self.atcli._unify_kwargs(args, task)
         self.assertEquals(ret_kwargs, ret_task_kwargs)
 
+    def test__unify_kwargs_cached_while_plan_indexed(self):
+        def load_task():
+            task = Mock()
+            task.kwargs = {'dict': '{"a": {"b": 5}}', 'name': 'vim'}
+            return task
+
+        self.atcli.plan_index = PlanIndex([])
+        with patch.object(self.atcli, '_safe_read_json',
+                          wraps=self.atcli._safe_read_json) as read_json:
+            # Tasks are loaded again by every command, but keep their
+            # positions in the plan
+            self.assertTrue(self.atcli._task_has_kwargs(load_task(),
+                ('dict.a.b=5',), (0, 1)))
+            self.assertEqual(3, read_json.call_count)
+            self.assertTrue(self.atcli._task_has_kwargs(load_task(),
+                ('dict.a.b=5',), (0, 1)))
+            self.assertTrue(self.atcli._task_has_kwargs(load_task(),
+                ('name=vim',), (0, 1)))
+            self.assertEqual(4, read_json.call_count)
+
+            # Tasks found without the index are read every time
+            self.assertTrue(self.atcli._task_has_kwargs(load_task(),
+                ('name=vim',)))
+            self.assertEqual(6, read_json.call_count)
+        # Matching dotted keys leaves the cached arguments as they were
+        self.assertTrue(self.atcli._task_has_kwargs_strict(load_task(),
+            ('dict={"a": {"b": 5}}', 'name=vim'), (0, 1)))
+
     def test__format_properties(self):
         task = Mock()
         task.kwargs = {'target_path': u'/var/lib/libvirt/instances/fmmed1',
@@ -1001,6 +1037,94 @@ class TestATCli(unittest.TestCase):
         self.assertRaises(AssertionError, lambda: self.atcli.command_assert_number_config_tasks(node1.hostname, '100'))
         self.assertRaises(AssertionError, lambda: self.atcli.command_assert_number_config_tasks(node1.hostname, '0'))
 
+    @threadlocal_scope
+    def test_task_args_read_once_per_plan_index(self):
+        self._create_model()
+        node1 = self.node1
+        item1 = self.item1
+        self.atcli.execution = MagicMock()
+        self.atcli.execution.plan_phases.side_effect = lambda: [[
+            ConfigTask(node1, item1, 'Desc1', 'foo', 'foo1', name='dummy')]]
+
+        with patch.object(self.atcli, '_read_task_kwargs',
+                          wraps=self.atcli._read_task_kwargs) as read_kwargs:
+            for _ in range(2):
+                self.assertEqual("Pass",
+                    self.atcli.command_assert_config_task(node1.hostname,
+                        'foo', 'foo1', item1.vpath, 'name=dummy'))
+            self.assertEqual(1, read_kwargs.call_count)
+
+    @threadlocal_scope
+    def test_plan_index_kept_between_assertions(self):
+        self.setup_assert_task()
+        node1 = self.node1
+        self.atcli.line = 1
+
+        with patch('litpats.atcli.PlanIndex', wraps=PlanIndex) as plan_index:
+            self.assertEqual(4, self.atcli._get_number_config_tasks(
+                node1.hostname))
+            self.assertEqual((0, 2), self.atcli._find_config_task_strict(
+                node1.hostname, 'foo', 'foo3', self.item1.vpath)[1:])
+            self.assertEqual("Pass",
+                self.atcli.command_assert_task_in_plan('foo', self.item1.vpath))
+            self.assertEqual(1, plan_index.call_count)
+
+            # Assertions can be interleaved with let variables
+            self.atcli.run('let', ['__task', 'ConfigTask'])
+            self.assertEqual(0, self.atcli._get_number_config_tasks('node2'))
+            self.assertEqual(1, plan_index.call_count)
+
+            # Other commands may change the plan
+            self.atcli.commands['runPlanEnd'] = Mock()
+            self.atcli.run('runPlanEnd', [])
+            self.assertEqual(0, self.atcli._get_number_config_tasks('node2'))
+            self.assertEqual(2, plan_index.call_count)
+
+            # and so may the commands run by assertError
+            self.atcli.run_command = Mock(return_value=1)
+            self.atcli.run('assertError', ['create_plan'])
+            self.assertEqual(0, self.atcli._get_number_config_tasks('node2'))
+            self.assertEqual(3, plan_index.call_count)
+
+    @threadlocal_scope
+    def test_task_assertions_batched_on_one_plan_reading(self):
+        self.setup_assert_task()
+        hostname = self.node1.hostname
+        vpath = self.item1.vpath
+        script = list(batch_assertions(compile_script("\n".join([
+            "let __task ConfigTask",
+            "assertConfigTask %s foo foo1 %s" % (hostname, vpath),
+            "assertConfigTask %s foo foo3 %s" % (hostname, vpath),
+            "assertNumberConfigTasks %s 4" % hostname,
+            "assertNoConfigTask %s foo foo9 %s" % (hostname, vpath)]))))
+        self.assertEqual(2, len(script))
+        self.assertTrue(isinstance(script[1], ScriptBatch))
+
+        results = self.atcli.run_assertions(script[1].lines)
+        self.assertEqual([2, 3, 4, 5],
+                         [line.line for line, _, _ in results])
+        self.assertEqual(["Pass"] * 4, [ret for _, ret, _ in results])
+        self.assertEqual(1, self.atcli.execution.plan_phases.call_count)
+
+        # Every failure is reported with its own line, and the plan is read
+        # once more for the next batch
+        script = compile_script("\n".join([
+            "assertConfigTask %s foo foo9 %s" % (hostname, vpath),
+            "assertConfigTask %s foo foo1 %s" % (hostname, vpath),
+            "assertNumberConfigTasks %s 100" % hostname]))
+        try:
+            self.atcli.run_assertions(list(script))
+        except AssertionError as ex:
+            message = str(ex)
+            self.assertTrue(message.startswith("Line 1: "))
+            self.assertTrue("\nLine 3: " in message)
+            self.assertFalse("Line 2: " in message)
+        else:
+            self.fail("AssertionError should have been raised")
+        self.assertEqual(1, self.atcli.line)
+        self.assertEqual(2, self.atcli.execution.plan_phases.call_count)
+        self.assertEqual(None, self.atcli.batch_phases)
+
     @patch('litpats.atcli.ATCli.get_item_source')
     @patch('litpats.atcli.ATCli.item_by_path')
     def test_assert_source(self,mock_item_by_path, mock_get_item_source):
@@ -1243,3 +1367,224 @@ class TestATCli(unittest.TestCase):
         result = atcli.command_assert_property_unset(
                 '-p', '/item', '-o', 'PROPERTY_NOT_THERE')
         self.assertEqual(result, "Pass")
+
+    @patch('litpats.atcli.LandscapeSnapshot')
+    def test_clear_landscape_restores_snapshot(self, mock_snapshot_class):
+        atcli = self.atcli
+        atcli.snapshot_landscape = True
+        atcli.create_litp_services = Mock()
+
+        atcli.run("clearLandscape", [])
+        self.assertEqual(1, mock_snapshot_class.call_count)
+        self.assertEqual(1, atcli.create_litp_services.call_count)
+        model_manager = atcli.model_manager
+        add_extensions_count = PluginManager.add_extensions.call_count
+
+        snapshot = mock_snapshot_class.return_value
+        atcli.run("clearLandscape", [])
+        self.assertEqual(1, mock_snapshot_class.call_count)
+        self.assertEqual(1, atcli.create_litp_services.call_count)
+        snapshot.restore.assert_called_once_with()
+
+        # A new model manager is built and the snapshotted plugin manager is
+        # bound to it, without loading the extensions again
+        self.assertNotEqual(model_manager, atcli.model_manager)
+        self.assertEqual(atcli.model_manager,
+                         cherrypy.config["model_manager"])
+        snapshot.bind.assert_called_once_with(atcli.model_manager)
+        self.assertEqual(snapshot.bind.return_value, atcli.plugin_manager)
+        self.assertEqual(add_extensions_count,
+                         PluginManager.add_extensions.call_count)
+
+    @patch('litpats.atcli.DbSnapshot')
+    def test_landscape_snapshot_bound_to_new_model_manager(self,
+                                                           mock_db_snapshot):
+        atcli = self.atcli
+        model_manager = atcli.model_manager
+        plugin_manager = atcli.plugin_manager
+        snapshot = LandscapeSnapshot(Mock(), Mock(), model_manager,
+                                     plugin_manager)
+
+        atcli._create_model_manager()
+        self.assertEqual(plugin_manager, snapshot.bind(atcli.model_manager))
+        self.assertEqual(atcli.model_manager, plugin_manager.model_manager)
+        self.assertEqual(sorted(model_manager.item_types),
+                         sorted(atcli.model_manager.item_types))
+        self.assertEqual(sorted(model_manager.property_types),
+                         sorted(atcli.model_manager.property_types))
+
+    @patch('litpats.atcli.ScriptCheckpoint')
+    def test_included_script_restored_from_checkpoint(self,
+                                                      mock_checkpoint_class):
+        atcli = self.atcli
+        atcli.filesystem = MagicMock()
+        atcli.test_dir = os.path.dirname(os.path.abspath(__file__))
+        atcli.script_checkpoints = MagicMock()
+        atcli.script_checkpoints.load.return_value = None
+        mock_checkpoint_class.covers.return_value = True
+        atcli._read_file = Mock(return_value="litp create -p /a")
+        atcli._buffer_logs = Mock(return_value=StringIO.StringIO())
+        atcli.command_run_litp_script = Mock()
+
+        # Only scripts included right after the landscape is cleared
+        atcli.run("runLitpScript", ["setup.inc"])
+        self.assertFalse(atcli.script_checkpoints.load.called)
+        self.assertEqual(1, atcli.command_run_litp_script.call_count)
+
+        atcli.landscape_cleared = True
+        atcli.run("runLitpScript", ["setup.inc"])
+        self.assertEqual(2, atcli.command_run_litp_script.call_count)
+        self.assertEqual(1, atcli.script_checkpoints.save.call_count)
+        self.assertFalse(atcli.landscape_cleared)
+
+        checkpoint = atcli.script_checkpoints.save.call_args[0][1]
+        atcli.script_checkpoints.load.return_value = checkpoint
+        atcli._restore_checkpoint = Mock()
+        atcli.landscape_cleared = True
+        atcli.run("runLitpScript", ["setup.inc"])
+        self.assertEqual(2, atcli.command_run_litp_script.call_count)
+        atcli._restore_checkpoint.assert_called_once_with(checkpoint)
+
+    def test_checkpoint_not_taken_after_plan_commands(self):
+        atcli = self.atcli
+        atcli.commands_run = set()
+        atcli.commands['litp'] = Mock()
+        atcli.commands['assertProperty'] = Mock()
+        atcli.run("litp", ["create", "-p", "/deployments/d1", "-t",
+                           "deployment"])
+        atcli.run("assertProperty", ["/deployments/d1", "-o", "name=d1"])
+        self.assertEqual(set(["litp create", "assertProperty"]),
+                         atcli.commands_run)
+        self.assertTrue(ScriptCheckpoint.covers(atcli.commands_run))
+
+        # The plan is not part of a checkpoint
+        atcli.run("litp", ["create_plan"])
+        self.assertFalse(ScriptCheckpoint.covers(atcli.commands_run))
+        self.assertFalse(ScriptCheckpoint.covers(["litp run_plan"]))
+        self.assertFalse(ScriptCheckpoint.covers(["runPlanEnd"]))
+
+    def test_env_substitutes_variables(self):
+        atcli = ATCli()
+        self.assertEqual("${name}", atcli._env("${name}"))
+
+        atcli.environment = {'NAME': 'node1', 'path': '/ms'}
+        self.assertEqual("hostname=node1 -p /ms",
+                         atcli._env("hostname=${name} -p '${path}'"))
+
+        # Changes to the variables are picked up
+        atcli.environment['path'] = '/deployments'
+        del atcli.environment['NAME']
+        self.assertEqual("${name} /deployments",
+                         atcli._env("${name} ${path}"))
+
+        # Quotes are only removed in pairs, and unknown or uppercased
+        # references are left as they are
+        self.assertEqual("'/deployments /deployments'",
+                         atcli._env("'${path} ${path}'"))
+        self.assertEqual("${PATH} '${other}'",
+                         atcli._env("${PATH} '${other}'"))
+
+    def test_mock_http_connection_parses_urls_once(self):
+        connection = MockHTTPConnection('localhost')
+        url = 'https://localhost:9999/litp/rest/v1/deployments?recurse=true'
+        with patch.object(connection, '_extract_path_info',
+                          wraps=connection._extract_path_info) as extract:
+            self.assertEqual(('/deployments', 'recurse=true',
+                              {'recurse': 'true'}), connection._parse_url(url))
+            self.assertEqual(('/deployments', 'recurse=true',
+                              {'recurse': 'true'}), connection._parse_url(url))
+            self.assertEqual(1, extract.call_count)
+        self.assertEqual('/litp/upgrade', connection._parse_url(
+            'https://localhost:9999/litp/upgrade')[0])
+
+    def test_command_litp_direct_dispatch(self):
+        atcli = ATCli()
+        atcli.line = 1
+        atcli.filesystem = MagicMock()
+        atcli.direct_dispatch = True
+        atcli.run_command = Mock(return_value=0)
+        connection = Mock()
+        atcli._create_http_connection = Mock(return_value=connection)
+
+        connection.getresponse.return_value.read.return_value = \
+            '{"id": "pkg", "item-type-name": "mock-package"}'
+        self.assertEqual(0, atcli.run('litp', ['create', '-p',
+            '/software/items/pkg', '-t', 'mock-package']))
+        connection.request.assert_called_once_with('POST',
+            'https://localhost:9999/litp/rest/v1/software/items',
+            {'id': 'pkg', 'type': 'mock-package'},
+            {'Content-Type': 'application/json'})
+        self.assertEqual({'id': 'pkg', 'item-type-name': 'mock-package'},
+                         atcli.result)
+        self.assertFalse(atcli.run_command.called)
+
+        connection.getresponse.return_value.read.return_value = \
+            '{"messages": [{"message": "Path not found"}]}'
+        self.assertRaises(AssertionError, atcli.run, 'litp',
+                          ['remove', '-p', '/software/items/pkg'])
+        self.assertFalse(atcli.run_command.called)
+
+        # Commands that cannot be dispatched directly use the CLI
+        atcli.run('litp', ['create_plan', '--no-lock-tasks'])
+        atcli.run_command.assert_called_once_with(
+            ['create_plan', '--no-lock-tasks'])
+
+    @threadlocal_scope
+    def _item_states(self, *vpaths):
+        states = []
+        for vpath in vpaths:
+            item = self.atcli.model_manager.get_item(vpath)
+            if item is None:
+                states.append(None)
+            else:
+                states.append((item.item_type_id, item.get_state(),
+                               dict(item.properties)))
+        return states
+
+    def test_direct_dispatch_matches_cli(self):
+        self.atcli.model_manager.register_item_type(ItemType(
+            "dispatched-package", extend_item="software-item",
+            name=Property("basic_string")))
+        commands = [
+            ['create', '-p', '/software/items/pkg', '-t',
+             'dispatched-package', '-o', 'name=pkg'],
+            ['update', '-p', '/software/items/pkg', '-o', 'name=pkg2'],
+            ['inherit', '-p', '/ms/items/pkg', '-s', '/software/items/pkg'],
+            ['show', '-p', '/ms/items/pkg'],
+            ['remove', '-p', '/ms/items/pkg'],
+            ['remove', '-p', '/software/items/pkg'],
+        ]
+
+        def run_commands(direct_dispatch):
+            # The commands leave the model as they found it, so that both
+            # runs start from the same state
+            self.atcli.direct_dispatch = direct_dispatch
+            steps = []
+            for command in commands:
+                self.assertEqual(0, self.atcli.run('litp', command))
+                steps.append((self.atcli.result, self._item_states(
+                    '/software/items/pkg', '/ms/items/pkg')))
+            return steps
+
+        self.atcli.run_command = Mock(wraps=self.atcli.run_command)
+        cli_steps = run_commands(False)
+        self.assertEqual(len(commands), self.atcli.run_command.call_count)
+        self.assertEqual(cli_steps, run_commands(True))
+        self.assertEqual(len(commands), self.atcli.run_command.call_count)
+
+    @patch('litpats.atcli.ATCli.run_command', Mock(return_value=1))
+    def test_assertError_parsers_built_once(self):
+        atcli = ATCli()
+        atcli.line = 1
+        atcli.result = {'messages': [{'type': 'CardinalityError',
+                                      'message': 'Too many'}]}
+        atcli.run('let', ['__err', '--err_type', 'CardinalityError'])
+        atcli.run('assertError', ['__err', 'create_plan'])
+
+        parsers = dict(ATCli._parsers)
+        spec = ATCli._let_error_specs[('--err_type', 'CardinalityError')]
+        atcli.run('assertError', ['__err', '--err_message', 'Too many',
+                                  'create_plan'])
+        self.assertEqual(parsers, ATCli._parsers)
+        self.assertTrue(spec is atcli._let_error_spec('__err'))
+        self.assertEqual('CardinalityError', spec.type)
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from litpats import atcompiler
+from litpats.atcompiler import AT_SCRIPT
+from litpats.atcompiler import INCLUDED_SCRIPT
+from litpats.atcompiler import ScriptBatch
+from litpats.atcompiler import ScriptLine
+from litpats.atcompiler import batch_assertions
+from litpats.atcompiler import compile_script
+
+
+AT = '''# Create a node
+litp create -p /deployments/d1 \\
+    -t deployment # a comment
+assertError --err_message "no \\# comment" create
+
+runLitpScript ../setup.inc
+'''
+
+
+class TestCompileScript(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        atcompiler._compiled_scripts.clear()
+
+    def tearDown(self):
+        atcompiler._compiled_scripts.clear()
+        shutil.rmtree(self.cache_dir)
+
+    def test_at_script(self):
+        self.assertEquals([
+            ScriptLine(3, 'litp', ['create', '-p', '/deployments/d1', '-t',
+                                   'deployment'], None),
+            ScriptLine(4, 'assertError', ['--err_message', 'no \\# comment',
+                                          'create'], None),
+            ScriptLine(6, 'runLitpScript', ['../setup.inc'], None),
+        ], compile_script(AT, AT_SCRIPT))
+
+    def test_included_script(self):
+        script = 'litp create -p /a \\\n    -t b # c\n../setup.inc\n#\n'
+        self.assertEquals([
+            ScriptLine(2, 'litp', ['create', '-p', '/a', '-t', 'b'], None),
+            ScriptLine(3, 'runLitpScript', ['../setup.inc'], None),
+        ], compile_script(script, INCLUDED_SCRIPT))
+
+    def test_unparsable_line_kept(self):
+        self.assertEquals([
+            ScriptLine(1, 'litp', ['create'], None),
+            ScriptLine(2, None, None, 'No closing quotation'),
+        ], compile_script('litp create\nlitp create -o name="x\n'))
+
+    def test_compiled_once(self):
+        script = compile_script(AT, AT_SCRIPT, self.cache_dir)
+        self.assertTrue(compile_script(AT, AT_SCRIPT) is script)
+        self.assertNotEquals(script, compile_script(AT, INCLUDED_SCRIPT))
+
+        # Other processes read the compiled script back from the cache
+        atcompiler._compiled_scripts.clear()
+        self.assertEquals(1, len(os.listdir(self.cache_dir)))
+        cached_script = compile_script(AT, AT_SCRIPT, self.cache_dir)
+        self.assertFalse(cached_script is script)
+        self.assertEquals(script, cached_script)
+        self.assertTrue(isinstance(cached_script[0].command, str))
+        self.assertTrue(isinstance(cached_script[0].args[0], str))
+
+
+class TestBatchAssertions(unittest.TestCase):
+    def test_consecutive_task_assertions_batched(self):
+        script = compile_script(
+            'litp create_plan\n'
+            'assertConfigTask node1 foo foo1 /ms\n'
+            'assertNoConfigTask node1 foo foo2 /ms\n'
+            '\n'
+            'assertCallbackTask _cb /ms\n'
+            'assertPlanState initial\n'
+            'assertTask 0 foo node1 /ms\n'
+            'litp run_plan\n'
+            'assertConfigTask node1 foo foo1 /ms\n')
+        self.assertEquals([
+            script[0],
+            ScriptBatch(script[1:4]),
+            script[4],
+            script[5],
+            script[6],
+            script[7],
+        ], list(batch_assertions(script)))
+        self.assertEquals([2, 3, 5], [line.line for line in
+                                      list(batch_assertions(script))[1].lines])
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from litpats.checkpoints import CheckpointStore
+from litpats.checkpoints import checkpoint_key
+
+
+class TestCheckpointStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_checkpoint_key(self):
+        key = checkpoint_key('/ats/setup.inc', 'litp create', [])
+        self.assertEquals(key, checkpoint_key('/ats/setup.inc', 'litp create',
+                                              []))
+        self.assertNotEquals(key, checkpoint_key('/ats/setup.inc',
+                                                 'litp create ', []))
+        self.assertNotEquals(key, checkpoint_key('/ats/setup.inc', 'litp',
+                                                 'create', []))
+
+    def test_saved_checkpoint_loaded(self):
+        store = CheckpointStore(self.tmp_dir)
+        self.assertEquals(None, store.load('key'))
+        self.assertTrue(store.save('key', {'files': ['/a']}))
+        self.assertEquals({'files': ['/a']}, store.load('key'))
+
+        # Processes sharing the directory see each other's checkpoints
+        self.assertEquals({'files': ['/a']},
+                          CheckpointStore(self.tmp_dir).load('key'))
+
+    def test_unpicklable_checkpoint_not_saved(self):
+        store = CheckpointStore(self.tmp_dir)
+        self.assertFalse(store.save('key', threading.Lock()))
+        self.assertEquals(None, store.load('key'))
+        self.assertEquals([], os.listdir(self.tmp_dir))
@@ -0,0 +1,87 @@
+import pickle
+import unittest
+
+from sqlalchemy import Column
+from sqlalchemy import ForeignKey
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+from sqlalchemy import create_engine
+
+from litpats.db_snapshot import DbSnapshot
+
+
+class TestDbSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.engine = self._create_engine()
+        self.metadata = MetaData()
+        self.items = Table('items', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('vpath', String(255), nullable=False))
+        self.properties = Table('properties', self.metadata,
+            Column('id', Integer, primary_key=True),
+            Column('item_id', Integer, ForeignKey('items.id'),
+                   nullable=False),
+            Column('value', String(255)))
+        self.metadata.create_all(self.engine)
+
+        self.engine.execute(self.items.insert(), [
+            {'id': 1, 'vpath': '/litp'},
+            {'id': 2, 'vpath': '/litp/logging'}])
+        self.engine.execute(self.properties.insert(), [
+            {'id': 1, 'item_id': 2, 'value': 'true'}])
+
+    def _create_engine(self):
+        engine = create_engine('sqlite://')
+        engine.execute('PRAGMA foreign_keys = ON')
+        return engine
+
+    def _rows(self, engine, table):
+        return sorted(tuple(row) for row in
+                      engine.execute(table.select()))
+
+    def test_restore(self):
+        snapshot = DbSnapshot.take(self.engine)
+
+        self.engine.execute(self.items.insert(),
+                            {'id': 3, 'vpath': '/deployments'})
+        self.engine.execute(self.properties.insert(),
+                            {'id': 2, 'item_id': 3, 'value': 'false'})
+        self.engine.execute(self.properties.update().values(value='false'))
+        self.engine.execute(self.properties.delete().where(
+            self.properties.c.id == 1))
+
+        snapshot.restore(self.engine)
+        self.assertEquals([(1, '/litp'), (2, '/litp/logging')],
+                          self._rows(self.engine, self.items))
+        self.assertEquals([(1, 2, 'true')],
+                          self._rows(self.engine, self.properties))
+
+        # A snapshot can be restored any number of times
+        self.engine.execute(self.properties.delete())
+        snapshot.restore(self.engine)
+        self.assertEquals([(1, 2, 'true')],
+                          self._rows(self.engine, self.properties))
+
+    def test_restore_empty_tables(self):
+        self.engine.execute(self.properties.delete())
+        snapshot = DbSnapshot.take(self.engine)
+
+        self.engine.execute(self.properties.insert(),
+                            {'id': 1, 'item_id': 1, 'value': 'true'})
+        snapshot.restore(self.engine)
+        self.assertEquals([], self._rows(self.engine, self.properties))
+        self.assertEquals([(1, '/litp'), (2, '/litp/logging')],
+                          self._rows(self.engine, self.items))
+
+    def test_unpickled_snapshot_restored_to_other_database(self):
+        snapshot = pickle.loads(pickle.dumps(DbSnapshot.take(self.engine)))
+
+        engine = self._create_engine()
+        self.metadata.create_all(engine)
+        snapshot.restore(engine)
+        self.assertEquals([(1, '/litp'), (2, '/litp/logging')],
+                          self._rows(engine, self.items))
+        self.assertEquals([(1, 2, 'true')],
+                          self._rows(engine, self.properties))
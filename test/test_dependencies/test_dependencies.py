@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from litpats.dependencies import DependencyStore
+
+
+class TestDependencyStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.at_path = self._write("test.at", "litp create -p /foo")
+        self.dep_path = self._write("plugin.py", "x = 1")
+        self.deps_dir = os.path.join(self.tmp_dir, "deps")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as dep_file:
+            dep_file.write(contents)
+        return path
+
+    def test_unrecorded_at_is_stale(self):
+        self.assertTrue(DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_recorded_at_is_not_stale(self):
+        DependencyStore(self.deps_dir).record(self.at_path, [self.dep_path])
+        self.assertFalse(
+            DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_changed_dependency(self):
+        DependencyStore(self.deps_dir).record(self.at_path, [self.dep_path])
+        self._write("plugin.py", "x = 2")
+        self.assertTrue(DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_changed_at(self):
+        DependencyStore(self.deps_dir).record(self.at_path, [])
+        self._write("test.at", "litp create -p /bar")
+        self.assertTrue(DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_removed_dependency(self):
+        DependencyStore(self.deps_dir).record(self.at_path, [self.dep_path])
+        os.remove(self.dep_path)
+        self.assertTrue(DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_temporary_files_ignored(self):
+        missing_path = os.path.join(self.tmp_dir, "gone.xsd")
+        DependencyStore(self.deps_dir).record(self.at_path, [missing_path])
+        self.assertFalse(
+            DependencyStore(self.deps_dir).is_stale(self.at_path))
+
+    def test_forget(self):
+        store = DependencyStore(self.deps_dir)
+        store.record(self.at_path, [self.dep_path])
+        store.forget(self.at_path)
+        self.assertTrue(store.is_stale(self.at_path))
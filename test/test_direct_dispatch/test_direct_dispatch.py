@@ -0,0 +1,58 @@
+import unittest
+
+from litpats.direct_dispatch import DirectRequest
+from litpats.direct_dispatch import direct_request
+
+
+class TestDirectDispatch(unittest.TestCase):
+
+    def test_create(self):
+        self.assertEqual(
+            DirectRequest('POST', '/software/items', {
+                'id': 'pkg', 'type': 'package',
+                'properties': {'name': 'vim', 'version': 'a=b'}}),
+            direct_request(['create', '-t', 'package', '-p',
+                            '/software/items/pkg', '-o', 'name=vim',
+                            'version=a=b']))
+        self.assertEqual(
+            DirectRequest('POST', '/deployments', {
+                'id': 'd1', 'type': 'deployment'}),
+            direct_request(['create', '-p', '/deployments/d1', '-t',
+                            'deployment']))
+
+    def test_inherit(self):
+        self.assertEqual(
+            DirectRequest('POST', '/ms/items', {
+                'id': 'pkg', 'inherit': '/software/items/pkg'}),
+            direct_request(['inherit', '-p', '/ms/items/pkg', '-s',
+                            '/software/items/pkg']))
+
+    def test_other_commands(self):
+        self.assertEqual(
+            DirectRequest('PUT', '/ms', {'properties': {'hostname': 'ms1'}}),
+            direct_request(['update', '-p', '/ms', '-o', 'hostname=ms1']))
+        self.assertEqual(DirectRequest('DELETE', '/ms/items/pkg', None),
+                         direct_request(['remove', '-p', '/ms/items/pkg']))
+        self.assertEqual(DirectRequest('GET', '/ms', None),
+                         direct_request(['show', '-p', '/ms']))
+        self.assertEqual(
+            DirectRequest('POST', '/plans', {'id': 'plan', 'type': 'plan'}),
+            direct_request(['create_plan']))
+
+    def test_falls_back_to_cli(self):
+        for args in (
+                [],
+                ['run_plan'],
+                ['create_plan', '--no-lock-tasks'],
+                ['show', '-p', '/ms', '-r'],
+                ['show', '--path', '/ms'],
+                ['create', '/software/items/pkg', '-t', 'package'],
+                ['create', '-p', '/software/items/pkg'],
+                ['create', '-p', 'software', '-t', 'package'],
+                ['create', '-p', '/', '-t', 'package'],
+                ['create', '-p', '/a', '-p', '/b', '-t', 'package'],
+                ['update', '-p', '/ms', '-o', 'hostname'],
+                ['update', '-p', '/ms', '-o'],
+                ['update', '-p', '/ms', '-d', 'hostname'],
+                ['remove', '-p']):
+            self.assertEqual(None, direct_request(args), args)
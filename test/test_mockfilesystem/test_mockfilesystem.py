@@ -2,6 +2,8 @@ import unittest
 import os
 import shutil
 import __builtin__
+import copy
+import pickle
 import tempfile
 
 from contextlib import contextmanager
@@ -14,6 +16,14 @@ from litpats.mockfilesystem import MockBuffer
 from litpats.mockfilesystem import MockFilesystem
 
 
+class PathRecorder(object):
+    def __init__(self):
+        self.paths = []
+
+    def add_path(self, path):
+        self.paths.append(path)
+
+
 class TestMockFilesystemCreateDestroy(unittest.TestCase):
     def setUp(self):
         self.root_path = '/opt/ericsson/nms/litp'
@@ -63,6 +73,19 @@ class TestMockFilesystemCreateDestroy(unittest.TestCase):
         for path in files:
             self.assertTrue(files[path].closed)
 
+    def test_baseline_loaded_once(self):
+        fs = mockfilesystem.create(self.root_path)
+        clock = fs._files['/etc/sysconfig/clock']
+        clock_contents = clock.dump()
+        fs.mock_open('/etc/sysconfig/clock', 'a').write('changed')
+        mockfilesystem.destroy()
+
+        fs = mockfilesystem.create(self.root_path)
+        other_clock = fs._files['/etc/sysconfig/clock']
+        self.assertFalse(other_clock is clock)
+        self.assertTrue(other_clock.dump() is clock_contents)
+        mockfilesystem.destroy()
+
     def test_hookup_release(self, test_idempotency=False):
         fs = mockfilesystem.create(self.root_path)
         self.assertTrue(isinstance(fs._instance, MockFilesystem))
@@ -524,8 +547,85 @@ class TestMockFilesystem(unittest.TestCase):
                     set(self.fs.mock_listdir(dirpath)),
                     set(['mock_file.txt']))
 
+    def test_is_real_path_hidden(self):
+        self.assertFalse(self.fs.is_real_path_hidden('/hidden_dir/file'))
+        self.fs.hide_real_directory('/hidden_dir')
+        self.fs.hide_real_directory('/other/hidden/')
+        self.assertTrue(self.fs.is_real_path_hidden('/hidden_dir/file'))
+        self.assertTrue(self.fs.is_real_path_hidden('/hidden_dir/sub/file'))
+        self.assertTrue(self.fs.is_real_path_hidden('/other/hidden/file'))
+        self.assertFalse(self.fs.is_real_path_hidden('/hidden_dir'))
+        self.assertFalse(self.fs.is_real_path_hidden('/hidden_dir_other/'))
+        self.assertFalse(self.fs.is_real_path_hidden('/other/file'))
+
+        # Cached answers do not outlive hiding more directories
+        self.fs.hide_real_directory('/other')
+        self.assertTrue(self.fs.is_real_path_hidden('/other/file'))
+
+    def test_real_paths_cached(self):
+        real_dir = tempfile.mktemp()
+        self.assertFalse(os.path.exists(real_dir))
+        self.assertFalse(os.path.isfile(real_dir))
+        self.assertEquals((1, 1), (self.fs.real_path_hits,
+                                   self.fs.real_path_misses))
+
+        # Changing the mocked filesystem forgets the cached answers
+        with self.real_dirs_created(real_dir):
+            os.makedirs('/mocked_dir')
+            self.assertTrue(os.path.isdir(real_dir))
+            self.assertEquals(2, self.fs.real_path_misses)
+
     def test_add_directory(self):
-        pass
+        real_dir = tempfile.mktemp()
+        with self.real_dirs_created(real_dir, real_dir + '/sub'):
+            for path, contents in (('/file1.txt', 'one\n'),
+                                   ('/sub/file2.txt', 'two\n'),
+                                   ('/sub/file3.txt', 'three\n')):
+                with self.fs.old_open(real_dir + path, 'w') as real_file:
+                    real_file.write(contents)
+            self.fs.add_directory('/added_dir', real_dir)
+
+            # Nothing is read or listed until it is looked up
+            self.assertFalse(self.fs._files.has_dir('/added_dir'))
+            self.assertTrue(os.path.exists('/added_dir/sub/file2.txt'))
+            self.assertTrue(self.fs._files['/added_dir/sub/file2.txt']._loader)
+            self.assertEquals(['file1.txt'], os.listdir('/added_dir'))
+            with open('/added_dir/sub/file2.txt') as mock_file:
+                self.assertEquals('two\n', mock_file.read())
+
+            # Files written or removed stay that way
+            with open('/added_dir/file1.txt', 'w') as mock_file:
+                mock_file.write('changed')
+            os.remove('/added_dir/sub/file3.txt')
+            self.assertEquals(['/added_dir/file1.txt',
+                               '/added_dir/sub/file2.txt'],
+                              sorted(self.fs.files_under('/added_dir')))
+            with open('/added_dir/file1.txt') as mock_file:
+                self.assertEquals('changed', mock_file.read())
+
+            # Adding the directory again restores its files
+            self.fs.add_directory('/added_dir', real_dir)
+            self.assertTrue(os.path.exists('/added_dir/sub/file3.txt'))
+            with open('/added_dir/file1.txt') as mock_file:
+                self.assertEquals('one\n', mock_file.read())
+
+    def test_add_directory_twice(self):
+        real_dir = tempfile.mktemp()
+        with self.real_dirs_created(real_dir, real_dir + '/sub'):
+            for path in ('/f.txt', '/sub/g.txt'):
+                with self.fs.old_open(real_dir + path, 'w') as real_file:
+                    real_file.write('f\n')
+            self.fs.add_directory('/twice_dir', real_dir)
+            self.assertEquals(['f.txt'], os.listdir('/twice_dir'))
+            with open('/twice_dir/new.txt', 'w') as mock_file:
+                mock_file.write('new')
+
+            self.fs.add_directory('/twice_dir', real_dir)
+            self.assertEquals(['f.txt', 'new.txt'],
+                              sorted(os.listdir('/twice_dir')))
+            self.assertTrue(os.path.isdir('/twice_dir/sub'))
+            with open('/twice_dir/f.txt') as mock_file:
+                self.assertEquals('f\n', mock_file.read())
 
     def test_add_file(self):
         pass
@@ -575,6 +675,150 @@ class TestMockFilesystem(unittest.TestCase):
             self.assertFalse(path.startswith('/new_dir/'))
         # TODO: Test and implement with real files
 
+    def test_mocked_paths_follow_mutations(self):
+        f = open('/index_dir/sub_dir/file1.txt', 'w')
+        f.close()
+        self.assertTrue(os.path.exists('/index_dir'))
+        self.assertTrue(os.path.isdir('/index_dir/sub_dir/'))
+        self.assertFalse(os.path.isdir('/index_dir/sub_dir/file1.txt'))
+        self.assertTrue(os.path.isfile('/index_dir/sub_dir/file1.txt'))
+
+        shutil.copy('/index_dir/sub_dir/file1.txt', '/index_dir/file2.txt')
+        os.rename('/index_dir/sub_dir/file1.txt', '/index_dir/file3.txt')
+        self.assertFalse(os.path.exists('/index_dir/sub_dir'))
+        self.assertEquals(['file2.txt', 'file3.txt'],
+                          sorted(os.listdir('/index_dir')))
+
+        os.remove('/index_dir/file2.txt')
+        os.remove('/index_dir/file3.txt')
+        self.assertFalse(os.path.exists('/index_dir'))
+        self.assertEquals(self.fs._paths(), self._reduced_paths())
+
+    def test_listdir_only_lists_direct_children(self):
+        for path in ('/listdir_dir/file1.txt', '/listdir_dir/sub/file2.txt',
+                     '/listdir_dir_other/file3.txt'):
+            open(path, 'w').close()
+        self.assertEquals(['file1.txt'], os.listdir('/listdir_dir'))
+        self.assertEquals(['file1.txt'], os.listdir('/listdir_dir/'))
+
+    def test_files_deepcopy(self):
+        open('/deepcopy_dir/file1.txt', 'w').close()
+        files = copy.deepcopy(self.fs._files)
+        self.assertTrue(files.has_dir('/deepcopy_dir'))
+        self.assertEquals(set(self.fs._files), set(files))
+
+    def test_tree_operations_only_visit_subtree(self):
+        for path in ('/tree_dir/file1.txt', '/tree_dir/sub/file2.txt',
+                     '/tree_dir_other/file3.txt'):
+            open(path, 'w').close()
+        self.assertEquals(['/tree_dir/file1.txt', '/tree_dir/sub/file2.txt'],
+                          sorted(self.fs.files_under('/tree_dir/')))
+
+        # Real file objects cannot be copied, and need not be
+        with tempfile.NamedTemporaryFile() as real_file:
+            self.fs.add_file('/real_dir/real_file', real_file.file)
+            shutil.copytree('/tree_dir', '/tree_copy')
+            shutil.rmtree('/tree_dir')
+        self.assertEquals(['/tree_copy/file1.txt', '/tree_copy/sub/file2.txt'],
+                          sorted(self.fs.files_under('/tree_copy')))
+        self.assertEquals([], self.fs.files_under('/tree_dir'))
+        self.assertFalse(os.path.exists('/tree_dir/sub'))
+        self.assertTrue(os.path.exists('/tree_dir_other/file3.txt'))
+        del self.fs._files['/real_dir/real_file']
+
+    def test_checkpoint(self):
+        with open('/checkpoint_dir/file1.txt', 'w') as mock_file:
+            mock_file.write('one')
+        self.fs.hide_real_directory('/hidden_dir')
+        state = pickle.loads(pickle.dumps(self.fs.checkpoint()))
+
+        with open('/checkpoint_dir/file1.txt', 'a') as mock_file:
+            mock_file.write('two')
+        open('/checkpoint_dir/file2.txt', 'w').close()
+        self.fs.restore_checkpoint(state)
+        self.fs.restore_checkpoint(state)
+        self.assertEquals(['file1.txt'], os.listdir('/checkpoint_dir'))
+        with open('/checkpoint_dir/file1.txt') as mock_file:
+            self.assertEquals('one', mock_file.read())
+        self.assertTrue(self.fs.is_real_path_hidden('/hidden_dir/file'))
+
+        # Real files cannot be checkpointed
+        with tempfile.NamedTemporaryFile() as real_file:
+            self.fs.add_file('/real_dir/real_file', real_file.file)
+            self.assertEquals(None, self.fs.checkpoint())
+        del self.fs._files['/real_dir/real_file']
+
+    def test_overlay_reads_reported(self):
+        real_dir = tempfile.mktemp()
+        with self.real_dirs_created(real_dir):
+            with self.fs.old_open(real_dir + '/read.txt', 'w') as real_file:
+                real_file.write('read')
+            with self.fs.old_open(real_dir + '/unread.txt', 'w') as real_file:
+                real_file.write('unread')
+            self.fs.dependency_tracker = PathRecorder()
+            try:
+                self.fs.add_directory('/reported_dir', real_dir)
+                self.assertEquals(['read.txt', 'unread.txt'],
+                                  sorted(os.listdir('/reported_dir')))
+                with open('/reported_dir/read.txt') as mock_file:
+                    mock_file.read()
+                self.assertEquals([real_dir + '/read.txt'],
+                                  self.fs.dependency_tracker.paths)
+            finally:
+                self.fs.dependency_tracker = None
+
+    def test_checkpoint_overlay_files_moved(self):
+        real_dir = tempfile.mktemp()
+        with self.real_dirs_created(real_dir):
+            for name in ('kept.txt', 'copied.txt', 'renamed.txt'):
+                with self.fs.old_open(real_dir + '/' + name, 'w') as real_file:
+                    real_file.write(name)
+            self.fs.add_directory('/overlay_dir', real_dir)
+            shutil.copy('/overlay_dir/copied.txt', '/moved_dir/copy.txt')
+            os.rename('/overlay_dir/renamed.txt', '/moved_dir/renamed.txt')
+            self.assertTrue(self.fs._files['/moved_dir/copy.txt']._loader)
+            state = pickle.loads(pickle.dumps(self.fs.checkpoint()))
+
+            # Unread files are only left out at their own overlay paths
+            self.assertEquals(['/moved_dir/copy.txt', '/moved_dir/renamed.txt'],
+                              sorted(path for path in state['files'] if
+                                     path.startswith(('/moved_dir/',
+                                                      '/overlay_dir/'))))
+            self.fs.restore_checkpoint(state)
+            self.assertEquals(['copy.txt', 'renamed.txt'],
+                              sorted(os.listdir('/moved_dir')))
+            with open('/moved_dir/copy.txt') as mock_file:
+                self.assertEquals('copied.txt', mock_file.read())
+            with open('/moved_dir/renamed.txt') as mock_file:
+                self.assertEquals('renamed.txt', mock_file.read())
+            self.assertEquals(['copied.txt', 'kept.txt'],
+                              sorted(os.listdir('/overlay_dir')))
+
+    def test_real_file_contents_cached(self):
+        with tempfile.NamedTemporaryFile() as real_file:
+            real_file.write("abc")
+            real_file.flush()
+            contents = self.fs._read_real_file(real_file.name)
+            self.assertEquals("abc", contents)
+            self.assertTrue(
+                self.fs._read_real_file(real_file.name) is contents)
+            real_file.write("def")
+            real_file.flush()
+            self.assertEquals("abcdef",
+                              self.fs._read_real_file(real_file.name))
+
+    def _reduced_paths(self):
+        paths = set()
+        for filepath in self.fs._files:
+            dirs = []
+            for token in filepath.split(os.path.sep):
+                if not token:
+                    dirs = ['']
+                    continue
+                dirs.append(token)
+                paths.add(os.path.sep.join(dirs))
+        return paths
+
 
 class TestMockFile(unittest.TestCase):
     def test_close(self):
@@ -584,7 +828,29 @@ class TestMockFile(unittest.TestCase):
         pass
 
     def test_dump(self):
-        pass
+        self.assertEquals("", MockFile().dump())
+        self.assertEquals("a\nb", MockFile("a\nb").dump())
+
+    def test_copy(self):
+        mock_file = MockFile("abc")
+        copied_file = mock_file.copy()
+        self.assertTrue(copied_file.dump() is mock_file.dump())
+        copied_file.append_line("def")
+        self.assertEquals("abc", mock_file.dump())
+        self.assertEquals("abc\ndef", copied_file.dump())
+        self.assertEquals([], MockFile().copy().lines)
+
+    def test_lines(self):
+        mock_file = MockFile()
+        self.assertEquals([], mock_file.lines)
+        mock_file.append_line("")
+        self.assertEquals([""], mock_file.lines)
+        mock_file.append_line("a\nb")
+        self.assertEquals(["", "a", "b"], mock_file.lines)
+        self.assertEquals("\na\nb", mock_file.dump())
+        mock_file.lines = ["c", "d"]
+        self.assertEquals("c\nd", mock_file.dump())
+        self.assertEquals(3, mock_file.size)
 
 
 class TestMockBuffer(unittest.TestCase):
@@ -592,22 +858,56 @@ class TestMockBuffer(unittest.TestCase):
         pass
 
     def test_tell(self):
-        pass
+        mock_buffer = MockBuffer(MockFile("abc\ndef"))
+        self.assertEquals(0, mock_buffer.tell())
+        mock_buffer.read(2)
+        self.assertEquals(2, mock_buffer.tell())
+        mock_buffer.readline()
+        self.assertEquals(4, mock_buffer.tell())
 
     def test_seek(self):
-        pass
+        mock_buffer = MockBuffer(MockFile("abcdef"))
+        mock_buffer.seek(-2, os.SEEK_END)
+        self.assertEquals(4, mock_buffer.tell())
+        self.assertEquals("ef", mock_buffer.read(10))
+        mock_buffer.seek(1)
+        mock_buffer.seek(2, os.SEEK_CUR)
+        self.assertEquals("de", mock_buffer.read(2))
 
     def test_read(self):
-        pass
+        mock_buffer = MockBuffer(MockFile("abcdef"))
+        self.assertEquals(["ab", "cd", "ef", ""],
+                          [mock_buffer.read(2) for _ in range(4)])
+        self.assertEquals("abcdef", mock_buffer.read())
 
     def test_readline(self):
-        pass
+        mock_buffer = MockBuffer(MockFile("abc\n\ndef"))
+        self.assertEquals(["abc\n", "\n", "def\n", ""],
+                          [mock_buffer.readline() for _ in range(4)])
 
     def test_readlines(self):
-        pass
+        mock_buffer = MockBuffer(MockFile("abc\ndef\n"))
+        self.assertEquals(["abc", "def", ""], mock_buffer.readlines())
 
     def test_write(self):
-        pass
+        mock_file = MockFile()
+        mock_buffer = MockBuffer(mock_file)
+        mock_buffer.write("abc\n")
+        mock_buffer.write("")
+        mock_buffer.write("def")
+        self.assertEquals("abc\ndef", mock_file.dump())
+        self.assertEquals("def", mock_buffer.read()[-3:])
+
+    def test_truncate(self):
+        mock_file = MockFile("abc\ndef")
+        mock_buffer = MockBuffer(mock_file)
+        mock_buffer.truncate(5)
+        self.assertEquals(["abc", "d"], mock_file.lines)
+        mock_buffer.seek(2)
+        mock_buffer.truncate()
+        self.assertEquals("ab", mock_file.dump())
+        mock_buffer.truncate(0)
+        self.assertEquals([], mock_file.lines)
 
     def test_close(self):
         pass
@@ -0,0 +1,177 @@
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import unittest
+
+from litpats.runners.distributed_runner import DistributedRunner
+from litpats.runners.distributed_runner import MAX_REQUEUES
+from litpats.runners.distributed_runner import parse_address
+from litpats.runners.distributed_runner import run_worker
+
+
+def _run(name):
+    print "%s ran in %d" % (name, os.getppid())
+    return not name.startswith("fail")
+
+
+def _run_until_released(path):
+    # Only finishes once the coordinator has seen the first line of output
+    print "started"
+    sys.stdout.flush()
+    deadline = time.time() + 5.0
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    print "finished"
+    return True
+
+
+class _ReleasingOutput(object):
+    # Releases the task waiting for the given path as soon as its output
+    # is written
+    def __init__(self, out, path):
+        self._out = out
+        self._path = path
+
+    def write(self, data):
+        self._out.write(data)
+        if "started" in data:
+            open(self._path, 'w').close()
+
+    def flush(self):
+        self._out.flush()
+
+
+def _start_worker(address, func=_run):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            run_worker(address, func, connect_timeout=5.0)
+            status = 0
+        finally:
+            os._exit(status)
+    return pid
+
+
+def _start_deserter(address):
+    # A worker that takes a task and goes away without running it
+    pid = os.fork()
+    if pid == 0:
+        try:
+            sock = socket.create_connection(address)
+            sock.sendall('{"op": "next"}\n')
+            sock.makefile('r').readline()
+        finally:
+            os._exit(0)
+    return pid
+
+
+class TestDistributedRunner(unittest.TestCase):
+    def setUp(self):
+        self.runner = DistributedRunner(('localhost', 0))
+        self.worker_pids = []
+
+    def tearDown(self):
+        for pid in self.worker_pids:
+            _, status = os.waitpid(pid, 0)
+            self.assertEquals(0, status)
+
+    def _run_with_captured_output(self):
+        with tempfile.TemporaryFile() as captured:
+            with tempfile.TemporaryFile() as captured_err:
+                stdout, stderr = sys.stdout, sys.stderr
+                sys.stdout, sys.stderr = captured, captured_err
+                try:
+                    results = self.runner.run_tasks()
+                finally:
+                    sys.stdout, sys.stderr = stdout, stderr
+                captured.seek(0)
+                captured_err.seek(0)
+                self.errors = captured_err.read()
+                return results, captured.read()
+
+    def test_parse_address(self):
+        self.assertEquals(('example.com', 8000),
+                          parse_address('example.com:8000'))
+        self.assertEquals(('localhost', 8000), parse_address(':8000'))
+        self.assertRaises(ValueError, parse_address, 'example.com')
+
+    def test_named_tasks_only(self):
+        self.assertRaises(TypeError, self.runner.add_task, _run, "a")
+        self.assertEquals([], self.runner.run_tasks())
+
+    def test_run_tasks_on_several_workers(self):
+        names = ["a", "fail_b", "c", "d", "e"]
+        for i, name in enumerate(names):
+            self.runner.add_timed_task(name, float(i), None)
+        for _ in range(3):
+            self.worker_pids.append(_start_worker(self.runner.address))
+
+        results, output = self._run_with_captured_output()
+        self.assertEquals([True, False, True, True, True], results)
+        lines = output.splitlines()
+        self.assertEquals(names, [line.split()[0] for line in lines])
+        worker_pids = set(int(line.split()[-1]) for line in lines)
+        self.assertTrue(worker_pids <= set(self.worker_pids))
+        self.assertEquals(set(names), set(self.runner.durations))
+
+    def test_task_requeued_when_worker_goes_away(self):
+        self.runner.add_timed_task("a", 0.0, None)
+        self.runner.add_timed_task("b", 0.0, None)
+
+        self.worker_pids.append(_start_deserter(self.runner.address))
+        self.worker_pids.append(_start_worker(self.runner.address))
+
+        results, output = self._run_with_captured_output()
+        self.assertEquals([True, True], results)
+        self.assertEquals(["a", "b"],
+                          [line.split()[0] for line in output.splitlines()])
+        self.assertTrue("went away, running it again" in self.errors)
+
+    def test_task_fails_when_workers_keep_going_away(self):
+        self.runner.add_timed_task("a", 0.0, None)
+        for _ in range(MAX_REQUEUES + 1):
+            self.worker_pids.append(_start_deserter(self.runner.address))
+
+        results, output = self._run_with_captured_output()
+        self.assertEquals([False], results)
+        self.assertEquals("", output)
+        self.assertTrue("went away 3 times" in self.errors)
+
+    def test_output_streamed_while_task_runs(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "released")
+            self.runner.add_timed_task(path, 0.0, None)
+            self.worker_pids.append(
+                _start_worker(self.runner.address, _run_until_released))
+
+            with tempfile.TemporaryFile() as captured:
+                stdout = sys.stdout
+                sys.stdout = _ReleasingOutput(captured, path)
+                try:
+                    results = self.runner.run_tasks()
+                finally:
+                    sys.stdout = stdout
+                captured.seek(0)
+                self.assertEquals("started\nfinished\n", captured.read())
+            self.assertEquals([True], results)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_live_output_prefixed(self):
+        self.runner = DistributedRunner(('localhost', 0), live_output=True)
+        self.runner.add_timed_task("a", 0.0, None)
+        self.runner.add_timed_task("b", 0.0, None)
+        self.worker_pids.append(_start_worker(self.runner.address))
+
+        results, output = self._run_with_captured_output()
+        self.assertEquals([True, True], results)
+        self.assertEquals(["[a] a", "[b] b"],
+                          [line.split(" ran")[0]
+                           for line in output.splitlines()])
@@ -0,0 +1,126 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from litpats.runners.forking_runner import ForkingRunner
+
+
+_warmed_up_in = []
+
+
+def _warm_up(marker):
+    _warmed_up_in.append((marker, os.getpid()))
+
+
+def _check_warmed_up(marker):
+    return _warmed_up_in == [(marker, os.getppid())]
+
+
+def _print_after(line, delay, repeat=2):
+    time.sleep(delay)
+    for _ in range(repeat):
+        print line
+    return True
+
+
+def _log_start(log_path, name):
+    with open(log_path, 'a') as log:
+        log.write(name + "\n")
+    return True
+
+
+class TestForkingRunner(unittest.TestCase):
+    def setUp(self):
+        del _warmed_up_in[:]
+
+    def test_run_tasks(self):
+        runner = ForkingRunner(2)
+        for result in (True, False, True):
+            runner.add_task(lambda r: r, result)
+        self.assertEquals([True, False, True], runner.run_tasks())
+
+    def test_initializer_runs_once_before_workers_fork(self):
+        runner = ForkingRunner(2, _warm_up, ('marker',))
+        for _ in range(3):
+            runner.add_task(_check_warmed_up, 'marker')
+        self.assertEquals([True, True, True], runner.run_tasks())
+        self.assertEquals([('marker', os.getpid())], _warmed_up_in)
+
+    def test_initializer_skipped_without_tasks(self):
+        runner = ForkingRunner(2, _warm_up, ('marker',))
+        self.assertEquals([], runner.run_tasks())
+        self.assertEquals([], _warmed_up_in)
+
+    def test_longest_tasks_start_first(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            log_path = os.path.join(tmp_dir, "started")
+            runner = ForkingRunner(1)
+            for name, duration in (("a", 1.0), ("b", 3.0), ("c", 2.0)):
+                runner.add_timed_task(name, duration, _log_start, log_path,
+                                      name)
+            runner.add_task(lambda: False)
+            self.assertEquals([True, True, True, False], runner.run_tasks())
+            with open(log_path) as log:
+                self.assertEquals(["b", "c", "a"], log.read().split())
+            self.assertEquals(set(["a", "b", "c"]), set(runner.durations))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_silent_workers_reaped_without_delay(self):
+        runner = ForkingRunner(1)
+        for _ in range(5):
+            runner.add_task(lambda: True)
+        start_time = time.time()
+        self.assertEquals([True] * 5, runner.run_tasks())
+        self.assertTrue(time.time() - start_time < 2.0)
+
+    def test_run_tasks_outside_main_thread(self):
+        runner = ForkingRunner(2)
+        for result in (True, False, True):
+            runner.add_task(lambda r: r, result)
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.extend(runner.run_tasks()))
+        thread.start()
+        thread.join()
+        self.assertEquals([True, False, True], results)
+
+    def _run_with_captured_output(self, runner):
+        with tempfile.TemporaryFile() as captured:
+            stdout = sys.stdout
+            sys.stdout = captured
+            try:
+                results = runner.run_tasks()
+            finally:
+                sys.stdout = stdout
+            captured.seek(0)
+            return results, captured.read()
+
+    def test_output_in_add_order(self):
+        runner = ForkingRunner(3)
+        for name, duration in (("a", 0.2), ("b", 0.0), ("c", 0.1)):
+            runner.add_task(_print_after, name, duration)
+        results, output = self._run_with_captured_output(runner)
+        self.assertEquals([True, True, True], results)
+        self.assertEquals("a\na\nb\nb\nc\nc\n", output)
+
+    def test_large_output_spooled(self):
+        runner = ForkingRunner(2)
+        runner.add_task(_print_after, "a", 0.2)
+        runner.add_task(_print_after, "b" * 1024, 0.0, 2048)
+        results, output = self._run_with_captured_output(runner)
+        self.assertEquals([True, True], results)
+        self.assertEquals("a\na\n" + ("b" * 1024 + "\n") * 2048, output)
+
+    def test_live_output_prefixed(self):
+        runner = ForkingRunner(2, live_output=True)
+        runner.add_timed_task("slow", 0.0, _print_after, "a", 0.2)
+        runner.add_timed_task("fast", 0.0, _print_after, "b", 0.0)
+        results, output = self._run_with_captured_output(runner)
+        self.assertEquals([True, True], results)
+        self.assertEquals("[fast] b\n[fast] b\n[slow] a\n[slow] a\n", output)
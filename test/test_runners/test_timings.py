@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from litpats.runners.timings import TimingDatabase
+from litpats.runners.timings import expected_makespan
+
+
+class TestTimingDatabase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "timings.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_load_missing_file(self):
+        timing_db = TimingDatabase.load(self.path)
+        self.assertEquals({}, timing_db.durations)
+        self.assertEquals(0.0, timing_db.expected_duration("a.at"))
+
+    def test_load_corrupt_file(self):
+        with open(self.path, 'w') as timings_file:
+            timings_file.write("{")
+        self.assertEquals({}, TimingDatabase.load(self.path).durations)
+
+    def test_save_and_load(self):
+        timing_db = TimingDatabase(self.path)
+        timing_db.update({"a.at": 1.0, "b.at": 3.0})
+        timing_db.save()
+
+        timing_db = TimingDatabase.load(self.path)
+        self.assertEquals(3.0, timing_db.expected_duration("b.at"))
+        # Untimed tasks are expected to take the mean duration
+        self.assertEquals(2.0, timing_db.expected_duration("c.at"))
+
+    def test_mean_duration_follows_updates(self):
+        timing_db = TimingDatabase(self.path, {"a.at": 1.0, "b.at": 3.0})
+        self.assertEquals(2.0, timing_db.expected_duration("c.at"))
+        timing_db.update({"b.at": 5.0, "c.at": 6.0})
+        self.assertEquals(6.0, timing_db.expected_duration("c.at"))
+        self.assertEquals(4.0, timing_db.expected_duration("d.at"))
+
+
+class TestExpectedMakespan(unittest.TestCase):
+    def test_no_tasks(self):
+        self.assertEquals(0.0, expected_makespan([], 4))
+
+    def test_longest_first(self):
+        self.assertEquals(7.0, expected_makespan([1, 2, 3, 4, 5, 6], 3))
+        self.assertEquals(21.0, expected_makespan([1, 2, 3, 4, 5, 6], 1))
+        self.assertEquals(6.0, expected_makespan([1, 2, 3, 4, 5, 6], 6))
@@ -0,0 +1,161 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from litpats import schema_cache
+from litpats.schema_cache import CachingEtree
+from litpats.schema_cache import XsdCache
+from litpats.schema_cache import caching_xml_schema
+from litpats.schema_cache import extensions_digest
+from litpats.schema_cache import xsd_digest
+
+
+class TestXsdCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, "cache")
+        os.mkdir(self.cache_dir)
+        self.ext_dir = os.path.join(self.tmp_dir, "extensions")
+        os.mkdir(self.ext_dir)
+        self._write_conf("core.conf", "class_name=core_extension\n")
+        self.written = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write_conf(self, name, contents):
+        with open(os.path.join(self.ext_dir, name), 'w') as conf_file:
+            conf_file.write(contents)
+
+    def _write_schema(self, schema_path):
+        self.written.append(schema_path)
+        with open(os.path.join(schema_path, "litp.xsd"), 'w') as xsd_file:
+            xsd_file.write("<xs:schema/>")
+
+    def test_schema_written_once(self):
+        schema_path = XsdCache(self.cache_dir).schema_path([self.ext_dir],
+                                                           self._write_schema)
+        self.assertTrue(os.path.isfile(os.path.join(schema_path, "litp.xsd")))
+        self.assertEquals(1, len(self.written))
+
+        # Another process sharing the cache directory finds it generated
+        self.assertEquals(schema_path, XsdCache(self.cache_dir).schema_path(
+            [self.ext_dir], self._write_schema))
+        self.assertEquals(1, len(self.written))
+        self.assertEquals([os.path.basename(os.path.dirname(
+            os.path.dirname(schema_path)))], os.listdir(self.cache_dir))
+
+    def test_schema_written_per_extension_set(self):
+        cache = XsdCache(self.cache_dir)
+        schema_path = cache.schema_path([self.ext_dir], self._write_schema)
+        other_path = cache.schema_path([self.ext_dir, self.tmp_dir],
+                                       self._write_schema)
+        self.assertNotEquals(schema_path, other_path)
+        self.assertEquals(2, len(self.written))
+
+    def test_digest_follows_extension_confs(self):
+        digest = extensions_digest([self.ext_dir])
+        self.assertEquals(digest, extensions_digest([self.ext_dir]))
+        self._write_conf("core.conf", "class_name=other_extension\n")
+        self.assertNotEquals(digest, extensions_digest([self.ext_dir]))
+
+    def test_failed_schema_not_cached(self):
+        def write_schema(schema_path):
+            raise IOError("Disk full")
+
+        cache = XsdCache(self.cache_dir)
+        self.assertRaises(IOError, cache.schema_path, [self.ext_dir],
+                          write_schema)
+        self.assertEquals([], os.listdir(self.cache_dir))
+        cache.schema_path([self.ext_dir], self._write_schema)
+        self.assertEquals(1, len(self.written))
+
+
+class FakeXmlSchema(object):
+    compiled = 0
+
+    def __init__(self, etree=None, file=None, **kwargs):
+        FakeXmlSchema.compiled += 1
+        self.file = file
+
+
+class FakeEtree(object):
+    XMLSchema = FakeXmlSchema
+
+    @staticmethod
+    def parse(source):
+        return source
+
+
+class CountingIo(object):
+    def __init__(self):
+        self.opened = []
+
+    def open(self, path, mode):
+        self.opened.append(os.path.basename(path))
+        return io.open(path, mode)
+
+
+class TestCachingXmlSchema(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.xsd_file = self._write("litp.xsd", "<xs:schema/>")
+        self._write("core.xsd", "<xs:schema/>")
+        FakeXmlSchema.compiled = 0
+        schema_cache._compiled_schemas.clear()
+        schema_cache._xsd_digests.clear()
+        self.xml_schema = caching_xml_schema(FakeXmlSchema)
+
+    def tearDown(self):
+        schema_cache._compiled_schemas.clear()
+        schema_cache._xsd_digests.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, name, contents):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as xsd_file:
+            xsd_file.write(contents)
+        return path
+
+    def test_schema_compiled_once_per_contents(self):
+        schema = self.xml_schema(file=self.xsd_file)
+        self.assertTrue(self.xml_schema(file=self.xsd_file) is schema)
+        self.assertEquals(1, FakeXmlSchema.compiled)
+
+        # Any of the XSDs next to it may be imported
+        self._write("core.xsd", "<xs:schema></xs:schema>")
+        self.assertFalse(self.xml_schema(file=self.xsd_file) is schema)
+        self.assertEquals(2, FakeXmlSchema.compiled)
+
+    def test_schema_not_from_file_not_cached(self):
+        self.xml_schema(object())
+        self.xml_schema(object())
+        self.xml_schema(file=os.path.join(self.tmp_dir, "missing.xsd"))
+        self.assertEquals(3, FakeXmlSchema.compiled)
+
+    def test_xsds_read_once_until_rewritten(self):
+        counting_io = CountingIo()
+        schema_cache.io = counting_io
+        try:
+            digest = xsd_digest(self.xsd_file)
+            self.assertEquals(digest, xsd_digest(self.xsd_file))
+            self.assertEquals(["core.xsd", "litp.xsd"], counting_io.opened)
+
+            self._write("core.xsd", "<xs:schema></xs:schema>")
+            self.assertNotEquals(digest, xsd_digest(self.xsd_file))
+            self.assertEquals(4, len(counting_io.opened))
+        finally:
+            schema_cache.io = io
+
+    def test_caching_etree(self):
+        etree = CachingEtree(FakeEtree)
+        schema = etree.XMLSchema(file=self.xsd_file)
+        self.assertTrue(etree.XMLSchema(file=self.xsd_file) is schema)
+        self.assertEquals(1, FakeXmlSchema.compiled)
+        self.assertEquals("<a/>", etree.parse("<a/>"))
+
+        # The module it stands in for is left alone
+        self.assertTrue(FakeEtree.XMLSchema is FakeXmlSchema)
+        self.assertTrue(isinstance(schema, FakeEtree.XMLSchema))